@@ -1,13 +1,85 @@
-from django.contrib import admin
+import operator
+from functools import reduce
+
+from django.contrib import admin, messages
+from django.core.exceptions import PermissionDenied
+from django.db.models import Q
+from django.utils.translation import ugettext_lazy as _
 from .models import Thread, Post
+from .search import search_index
+
+
+class DisqusModelAdmin(admin.ModelAdmin):
+    actions = ['delete_in_batches']
+
+    def message_bulk_result(self, request, verb, count, failures):
+        name = self.model._meta.verbose_name_plural
+        if count:
+            self.message_user(request, "Successfully %s %d %s." % (verb, count, name), messages.SUCCESS)
+        # Group the failed objects by the error
+        errors = {}
+        for obj_id, error in failures.items():
+            errors.setdefault(str(error), []).append(str(obj_id))
+        for error, obj_ids in sorted(errors.items()):
+            self.message_user(
+                request,
+                "Failed to handle %s %s: %s" % (name, ', '.join(sorted(obj_ids)), error),
+                messages.ERROR
+            )
+
+    def delete_queryset(self, request, queryset):
+        count, failures = queryset.delete()
+        if failures:
+            self.message_bulk_result(request, 'deleted', 0, failures)
 
+    def delete_in_batches(self, request, queryset):
+        # `delete_selected` fetches every selected object to list them, and
+        # `delete_queryset` which reports the failures needs Django 2.1+
+        if not self.has_delete_permission(request):
+            raise PermissionDenied
+        count, failures = queryset.delete()
+        self.message_bulk_result(request, 'deleted', count, failures)
+    delete_in_batches.short_description = _("Delete selected %(verbose_name_plural)s in batches")
 
-class PostAdmin(admin.ModelAdmin):
+    def get_search_results(self, request, queryset, search_term):
+        if not search_term:
+            return queryset, False
+        if search_index.enabled:
+            ids = search_index.search(queryset._iterable_class.entity, search_term)
+            return queryset.filter(pk__in=ids), False
+        # Without the index, every fetched row is checked. Like Django admin,
+        # each word has to match any of the search fields.
+        for bit in search_term.split():
+            queryset = queryset.filter(reduce(operator.or_, [
+                Q(**{'%s__icontains' % field_name: bit}) for field_name in self.search_fields
+            ]))
+        return queryset, False
+
+
+class PostAdmin(DisqusModelAdmin):
     list_display = ['id', 'forum', 'message']
+    search_fields = ['message']
+    actions = DisqusModelAdmin.actions + ['approve_posts', 'spam_posts', 'restore_posts']
+
+    def approve_posts(self, request, queryset):
+        count, failures = queryset.approve()
+        self.message_bulk_result(request, 'approved', count, failures)
+    approve_posts.short_description = _("Approve selected posts")
+
+    def spam_posts(self, request, queryset):
+        count, failures = queryset.spam()
+        self.message_bulk_result(request, 'marked as spam', count, failures)
+    spam_posts.short_description = _("Mark selected posts as spam")
+
+    def restore_posts(self, request, queryset):
+        count, failures = queryset.restore()
+        self.message_bulk_result(request, 'restored', count, failures)
+    restore_posts.short_description = _("Restore selected posts")
 
 
-class ThreadAdmin(admin.ModelAdmin):
+class ThreadAdmin(DisqusModelAdmin):
     list_display = ['id', 'title', 'link', 'forum']
+    search_fields = ['title']
 
 admin.site.register([Thread], ThreadAdmin)
 admin.site.register([Post], PostAdmin)
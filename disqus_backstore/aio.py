@@ -0,0 +1,315 @@
+"""
+Asyncio counterparts of `disqus_backstore.disqus_interface`.
+
+It requires Python 3.6+ and aiohttp. The requests are sent through one
+`aiohttp.ClientSession`, at most `DISQUS_ASYNC_CONCURRENCY` of them at the
+same time, so independent fetches overlap instead of adding up:
+
+    threads = await async_disqus_query.get_threads([1, 2, 3])
+    async for thread in Thread.objects.filter(forum='foo'):
+        ...
+
+Write operations are only provided by the blocking `DisqusQuery`.
+"""
+import asyncio
+import weakref
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from .disqus_interface import (DisqusClient, DisqusQuery, DISQUSAPIError, RateLimitExceeded, RequestError,
+                               disqus_client, orjson, post_cursor_cache, project_response,
+                               thread_cursor_cache)
+from .mirror import read_from_mirror
+from .scheduler import READ, WRITE, current_priority
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+def encode_params(params):
+    """
+    aiohttp doesn't expand lists like requests does,
+    lists are sent as repeated parameters here.
+    """
+    items = []
+    for key, value in sorted(params.items()):
+        values = value if isinstance(value, (list, tuple)) else [value]
+        for v in values:
+            if isinstance(v, bool):
+                v = int(v)
+            items.append((key, str(v)))
+    return items
+
+
+class AsyncDisqusClient(object):
+    """
+    The asyncio version of `DisqusClient`. The session and the semaphore
+    are bound to an event loop, so they're created on first use in each
+    running loop, ex. once per `asyncio.run()`. Requests go through the
+    `RequestScheduler` of the blocking client, so both stay within the
+    same Disqus rate limit.
+    """
+    api_template = DisqusClient.api_template
+    rate_limit_code = DisqusClient.rate_limit_code
+
+    def __init__(self, concurrency=None, timeout=None, scheduler=None):
+        if aiohttp is None:
+            raise ImproperlyConfigured("aiohttp is required by the async Disqus client.")
+        self.concurrency = concurrency or getattr(settings, "DISQUS_ASYNC_CONCURRENCY", 10)
+        self.timeout = timeout or getattr(settings, "DISQUS_HTTP_TIMEOUT", 10)
+        # The rate limit budget is shared with the blocking client
+        self.scheduler = scheduler or disqus_client.scheduler
+        # event loop -> (session, semaphore)
+        self._loop_states = weakref.WeakKeyDictionary()
+
+    def loop_state(self):
+        loop = asyncio.get_event_loop()
+        state = self._loop_states.get(loop)
+        if state is None or state[0].closed:
+            session = aiohttp.ClientSession(
+                headers={'Accept-Encoding': 'gzip, deflate'},
+                connector=aiohttp.TCPConnector(limit=self.concurrency),
+            )
+            semaphore = state[1] if state is not None else asyncio.Semaphore(self.concurrency)
+            state = self._loop_states[loop] = (session, semaphore)
+        return state
+
+    @property
+    def session(self):
+        return self.loop_state()[0]
+
+    @property
+    def semaphore(self):
+        return self.loop_state()[1]
+
+    async def close(self):
+        """Close the session of the running event loop"""
+        state = self._loop_states.pop(asyncio.get_event_loop(), None)
+        if state is not None:
+            await state[0].close()
+
+    async def request(self, model_name, method_name, header, params, timeout=None, priority=None):
+        if header not in ("get", "post"):
+            raise RequestError("We can't handle header {header}".format(header=header))
+        api_url = self.api_template.format(model_name=model_name, method_name=method_name)
+        if timeout is None:
+            timeout = self.timeout
+        if priority is None:
+            priority = current_priority(WRITE if header == "post" else READ)
+        loop = asyncio.get_event_loop()
+        attempt = 0
+        async with self.semaphore:
+            while True:
+                # The scheduler blocks, so it waits in the default executor
+                if not await loop.run_in_executor(None, self.scheduler.acquire, priority):
+                    raise RateLimitExceeded("The Disqus rate limit is exhausted.")
+                retry = False
+                try:
+                    async with self.session.request(
+                        header.upper(), api_url, params=encode_params(params),
+                        timeout=aiohttp.ClientTimeout(total=timeout),
+                    ) as response:
+                        self.scheduler.update(response.headers)
+                        if response.status >= 500:
+                            error = RequestError("Disqus responded {status}".format(status=response.status))
+                            if header == "post":
+                                raise error
+                            retry = True
+                        elif response.status == 429:
+                            self.scheduler.exhaust()
+                            raise RateLimitExceeded("The Disqus rate limit is exhausted.")
+                        elif orjson is not None:
+                            response = orjson.loads(await response.read())
+                        else:
+                            response = await response.json(content_type=None)
+                except aiohttp.ClientConnectorError as e:
+                    # The request hasn't been sent, even a write can be retried
+                    retry = True
+                    error = RequestError(e)
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                    # A write may have been applied already, so it isn't repeated
+                    if header == "post":
+                        raise RequestError(e)
+                    retry = True
+                    error = RequestError(e)
+                except (aiohttp.ClientError, ValueError) as e:
+                    raise RequestError(e)
+                finally:
+                    self.scheduler.release()
+                if not retry:
+                    break
+                if attempt >= self.scheduler.max_retries:
+                    raise error
+                await loop.run_in_executor(None, self.scheduler.backoff, attempt)
+                attempt += 1
+        if response["code"] == self.rate_limit_code:
+            self.scheduler.exhaust()
+            raise RateLimitExceeded(response["response"])
+        if response["code"] != 0:
+            # Error occur, just raise exception with response message
+            raise DISQUSAPIError(response["response"])
+        return project_response(model_name, method_name, response)
+
+
+_async_client = None
+
+
+def get_async_client():
+    global _async_client
+    if _async_client is None:
+        _async_client = AsyncDisqusClient()
+    return _async_client
+
+
+async def async_send_request_to_disqus(model_name, method_name, header, params, timeout=None):
+    return await get_async_client().request(model_name, method_name, header, params, timeout=timeout)
+
+
+class AsyncDisqusQuery(object):
+    """
+    The read methods of `DisqusQuery` as coroutines. The parameters
+    are built by the same `DisqusQuery` methods and the results share
+    their `query_cache`. Identical calls awaiting at the same time
+    share one request.
+    """
+    page_size = DisqusQuery.page_size
+    public_key = DisqusQuery.public_key
+    secret_key = DisqusQuery.secret_key
+    forum = DisqusQuery.forum
+    access_token = DisqusQuery.access_token
+
+    cursor_caches = {
+        'thread': thread_cursor_cache,
+        'post': post_cursor_cache,
+    }
+
+    def __init__(self, client=None):
+        self._client = client
+        # event loop -> {(method name, key): future}
+        self._inflight = weakref.WeakKeyDictionary()
+
+    @property
+    def client(self):
+        return self._client or get_async_client()
+
+    async def cached(self, method_name, args, kwargs):
+        query_cache = DisqusQuery.__dict__[method_name]
+        store, key, record = query_cache.lookup(args, kwargs)
+        if record is not None:
+            return record.result
+        inflight = self._inflight.setdefault(asyncio.get_event_loop(), dict())
+        future = inflight.get((method_name, key))
+        if future is None:
+            generation = store.generation
+            future = asyncio.ensure_future(query_cache.func(self, *args, **kwargs))
+            inflight[(method_name, key)] = future
+            try:
+                result = await future
+            finally:
+                del inflight[(method_name, key)]
+            # Don't save the result if a write operation has
+            # changed the cache since it was requested.
+            if store.generation == generation:
+                query_cache.save(store, key, kwargs, result)
+            return result
+        return await future
+
+    async def get_threads_list(self, *args, **kwargs):
+        return await self.cached('get_threads_list', args, kwargs)
+
+    async def get_posts_list(self, *args, **kwargs):
+        return await self.cached('get_posts_list', args, kwargs)
+
+    async def get_thread(self, thread_id):
+        return await self.cached('get_thread', (thread_id,), {})
+
+    async def get_post(self, post_id):
+        return await self.cached('get_post', (post_id,), {})
+
+    async def get_threads(self, thread_ids):
+        """Fetch the details of `thread_ids` concurrently"""
+        return await asyncio.gather(*(self.get_thread(i) for i in thread_ids))
+
+    async def get_posts(self, post_ids):
+        """Fetch the details of `post_ids` concurrently"""
+        return await asyncio.gather(*(self.get_post(i) for i in post_ids))
+
+    async def list_rows(self, entity, offset=0, limit=None, **kwargs):
+        """
+        The coroutine version of `DisqusQuery.iter_rows`,
+        return the list of rows.
+        """
+        list_method = self.get_threads_list if entity == 'thread' else self.get_posts_list
+        cursor_cache = self.cursor_caches[entity]
+        result = []
+        if limit is not None and limit <= 0:
+            return result
+        position, cursor = cursor_cache.seek(kwargs, offset)
+        while True:
+            skip = offset - position
+            if skip > 0:
+                page_limit = min(skip, self.page_size)
+            elif limit is not None:
+                page_limit = min(limit - len(result), self.page_size)
+            else:
+                page_limit = self.page_size
+            page = await list_method(cursor=cursor, limit=page_limit, **kwargs)
+            rows = page['response']
+            position += len(rows)
+            page_cursor = page.get('cursor') or {}
+            has_next = page_cursor.get('hasNext')
+            if has_next:
+                cursor_cache.record(kwargs, position, page_cursor['next'])
+            result.extend(rows[skip:] if skip > 0 else rows)
+            if limit is not None and len(result) >= limit:
+                return result[:limit]
+            if not has_next or not rows:
+                return result
+            cursor = page_cursor['next']
+
+    async def fetch_rows(self, entity, thread_ids=None, offset=0, limit=None, **kwargs):
+        if thread_ids is None:
+            return await self.list_rows(entity, offset=offset, limit=limit, **kwargs)
+        # The pages of `threads/list` are fetched concurrently
+        chunks = [thread_ids[i:i + self.page_size]
+                  for i in range(0, len(thread_ids), self.page_size)]
+        pages = await asyncio.gather(*(
+            self.list_rows(entity, thread_ids=chunk, **kwargs) for chunk in chunks
+        ))
+        rows = [row for page in pages for row in page]
+        return rows[offset:None if limit is None else offset + limit]
+
+    async def fetch_details(self, entity, pks):
+        details = await asyncio.gather(*(self.fetch_detail(entity, pk) for pk in pks))
+        return [row for rows in details for row in rows]
+
+    async def fetch_detail(self, entity, pk):
+        get_detail = self.get_thread if entity == 'thread' else self.get_post
+        try:
+            return [(await get_detail(pk))['response']]
+        except DISQUSAPIError:
+            return []
+
+
+async_disqus_query = AsyncDisqusQuery()
+
+
+async def aiterate(queryset):
+    """
+    The async iterator of `DisqusQuerySet`. Like iterating the
+    queryset, the whole result is fetched into the result cache first.
+    """
+    if queryset._result_cache is None and read_from_mirror():
+        # The local mirror is read by the blocking database API
+        queryset._fetch_all()
+    if queryset._result_cache is None:
+        iterable = queryset._iterable_class(queryset)
+        method_name, kwargs, query_objs, ordering = iterable.source()
+        rows = await getattr(async_disqus_query, method_name)(iterable.entity, **kwargs)
+        rows = iterable.select_rows(rows, query_objs, ordering)
+        queryset._result_cache = list(iterable.build_rows(rows))
+    for obj in queryset._result_cache:
+        yield obj
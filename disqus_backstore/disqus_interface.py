@@ -1,38 +1,173 @@
-import sys
+from multiprocessing.pool import ThreadPool
 
 import requests
+from requests.adapters import HTTPAdapter
 
 from django.conf import settings
 
-from .utils import cache_clearer, query_cache
+from .exceptions import DISQUSAPIError, RateLimitExceeded, RequestError
+from .scheduler import READ, WRITE, RequestScheduler, current_priority, request_priority
+from .utils import CursorCache, cache_clearer, cache_patcher, cache_registry, query_cache
 
-class RequestError(Exception):
-    pass
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
+# The keys of the rows kept by `project_response`, Disqus returns much
+# more, ex. the author profile, the media and the HTML of the message.
+THREAD_KEYS = ['id', 'title', 'link', 'forum', 'isClosed', 'createdAt']
+POST_KEYS = ['id', 'forum', 'isApproved', 'isSpam', 'raw_message', 'thread', 'createdAt', 'author']
+AUTHOR_KEYS = ['name', 'username']
 
-class DISQUSAPIError(Exception):
-    pass
+# (model_name, method_name) -> the keys of the returned rows
+PROJECTIONS = {
+    ('forums', 'listThreads'): THREAD_KEYS,
+    ('threads', 'list'): THREAD_KEYS,
+    ('threads', 'details'): THREAD_KEYS,
+    ('forums', 'listPosts'): POST_KEYS,
+    ('threads', 'listPosts'): POST_KEYS,
+    ('posts', 'details'): POST_KEYS,
+}
 
 
-def send_request_to_disqus(model_name, method_name, header, params):
+def decode_json(response):
+    """Decode the body by orjson if it's installed, it's much faster"""
+    if orjson is not None:
+        return orjson.loads(response.content)
+    return response.json()
+
+
+def project_row(row, keys):
+    projected = dict((key, row[key]) for key in keys if key in row)
+    author = projected.get('author')
+    if isinstance(author, dict):
+        projected['author'] = dict((key, author[key]) for key in AUTHOR_KEYS if key in author)
+    return projected
+
+
+def project_response(model_name, method_name, response):
+    """
+    Keep only the keys of the rows which are used by the models,
+    so the cached results are smaller. It can be turned off by
+    `DISQUS_TRIM_RESPONSES = False`.
+    """
+    keys = PROJECTIONS.get((model_name, method_name))
+    if keys is None or not getattr(settings, "DISQUS_TRIM_RESPONSES", True):
+        return response
+    rows = response.get('response')
+    if isinstance(rows, dict):
+        response['response'] = project_row(rows, keys)
+    elif isinstance(rows, list):
+        response['response'] = [project_row(row, keys) for row in rows]
+    return response
+
+
+class DisqusClient(object):
+    """
+    A client which owns a reused `requests.Session`, so every API call
+    shares a keep-alive connection pool to disqus.com instead of paying a
+    new TCP/TLS handshake per request.
+    The pool size and the per-call timeout can be set by the
+    `DISQUS_HTTP_POOL_SIZE` and `DISQUS_HTTP_TIMEOUT` settings.
+    Requests go through a `RequestScheduler`, which keeps them within
+    the Disqus rate limit and retries 5xx responses and timeouts of reads.
+    """
     api_template = 'https://disqus.com/api/3.0/{model_name}/{method_name}.json'
-    api_url = api_template.format(model_name=model_name, method_name=method_name)
-    try:
-        if header == "get":
-            response = requests.get(api_url, params=params).json()
-        elif header == "post":
-            response = requests.post(api_url, params=params).json()
-        else:
+    # The error code of "You have exceeded your hourly limit of requests"
+    rate_limit_code = 13
+
+    def __init__(self, pool_size=None, timeout=None, scheduler=None):
+        self.pool_size = pool_size or getattr(settings, "DISQUS_HTTP_POOL_SIZE", 10)
+        self.timeout = timeout or getattr(settings, "DISQUS_HTTP_TIMEOUT", 10)
+        self.scheduler = scheduler or RequestScheduler(concurrency=self.pool_size)
+        self._session = None
+
+    @property
+    def session(self):
+        if self._session is None:
+            self._session = self.create_session()
+        return self._session
+
+    def create_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=self.pool_size,
+            pool_maxsize=self.pool_size,
+        )
+        session.mount('https://', adapter)
+        session.headers.update({
+            'Accept-Encoding': 'gzip, deflate',
+            'Connection': 'keep-alive',
+        })
+        return session
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+    def request(self, model_name, method_name, header, params, timeout=None, priority=None):
+        if header not in ("get", "post"):
             raise RequestError("We can't handle header {header}".format(header=header))
-    except:
-        e = sys.exc_info()[0]
-        raise RequestError(e)
-    else:
+        api_url = self.api_template.format(model_name=model_name, method_name=method_name)
+        if timeout is None:
+            timeout = self.timeout
+        if priority is None:
+            priority = current_priority(WRITE if header == "post" else READ)
+        send = getattr(self.session, header)
+        attempt = 0
+        while True:
+            if not self.scheduler.acquire(priority):
+                raise RateLimitExceeded("The Disqus rate limit is exhausted.")
+            retry = False
+            try:
+                response = send(api_url, params=params, timeout=timeout)
+                self.scheduler.update(response.headers)
+                if response.status_code >= 500:
+                    error = RequestError("Disqus responded {status}".format(status=response.status_code))
+                    if header == "post":
+                        raise error
+                    retry = True
+                elif response.status_code == 429:
+                    self.scheduler.exhaust()
+                    raise RateLimitExceeded("The Disqus rate limit is exhausted.")
+                else:
+                    response = decode_json(response)
+            except requests.ConnectTimeout as e:
+                # The request hasn't been sent, even a write can be retried
+                retry = True
+                error = RequestError(e)
+            except (requests.Timeout, requests.ConnectionError) as e:
+                # A write may have been applied already, so it isn't repeated
+                if header == "post":
+                    raise RequestError(e)
+                retry = True
+                error = RequestError(e)
+            except (requests.RequestException, ValueError) as e:
+                raise RequestError(e)
+            finally:
+                self.scheduler.release()
+            if not retry:
+                break
+            if attempt >= self.scheduler.max_retries:
+                raise error
+            self.scheduler.backoff(attempt)
+            attempt += 1
+        if response["code"] == self.rate_limit_code:
+            self.scheduler.exhaust()
+            raise RateLimitExceeded(response["response"])
         if response["code"] != 0:
             # Error occur, just raise exception with response message
             raise DISQUSAPIError(response["response"])
-        else:
-            return response
+        return project_response(model_name, method_name, response)
+
+disqus_client = DisqusClient()
+
+
+def send_request_to_disqus(model_name, method_name, header, params, timeout=None):
+    return disqus_client.request(model_name, method_name, header, params, timeout=timeout)
+
 
 class DisqusQuery(object):
     select_related = False
@@ -42,24 +177,41 @@ class DisqusQuery(object):
     forum = getattr(settings, "DISQUS_FORUM_SHORTNAME")
     access_token = getattr(settings, "DISQUS_ACCESS_TOKEN")
 
+    def __init__(self, client=None):
+        self.client = client or disqus_client
+
+    # The maximum number of rows Disqus returns in one page
+    page_size = 100
+
     @query_cache('thread')
-    def get_threads_list(self, *args, **kwargs):
-        model_name = "forums"
-        method_name = "listThreads"
+    def get_threads_list(self, thread_ids=None, cursor=None, limit=None, **kwargs):
         params = {
             'api_secret': self.secret_key,
             'forum': self.forum,
-            'limit': 100,
+            'limit': limit or self.page_size,
         }
+        if cursor:
+            params['cursor'] = cursor
         header = "get"
         params.update(kwargs)
-        return send_request_to_disqus(model_name, method_name, header, params)
+        if thread_ids:
+            # thread_ids must be a list of thread id,
+            # they are sent as repeated `thread` parameters
+            params['thread'] = list(thread_ids)
+            model_name = "threads"
+            method_name = "list"
+            return self.client.request(model_name, method_name, header, params)
+        else:
+            model_name = "forums"
+            method_name = "listThreads"
+            return self.client.request(model_name, method_name, header, params)
 
     @query_cache('post')
-    def get_posts_list(self, thread_id=None, **kwargs):
+    def get_posts_list(self, thread_id=None, cursor=None, limit=None, **kwargs):
         params = {
             'api_secret': self.secret_key,
             'forum': self.forum,
+            'limit': limit or self.page_size,
             'include': [
                 "unapproved",
                 "approved",
@@ -68,18 +220,79 @@ class DisqusQuery(object):
                 "highlighted"
             ],
         }
+        if cursor:
+            params['cursor'] = cursor
+        params.update(kwargs)
         if thread_id:
             params['thread'] = thread_id
             model_name = "threads"
             method_name = "listPosts"
             header = "get"
-            return send_request_to_disqus(model_name, method_name, header, params)
+            return self.client.request(model_name, method_name, header, params)
         else:
-            params['forum'] = self.forum
             model_name = "forums"
             method_name = "listPosts"
             header = "get"
-            return send_request_to_disqus(model_name, method_name, header, params)
+            return self.client.request(model_name, method_name, header, params)
+
+    def iter_pages(self, list_method, cursor=None, **kwargs):
+        """
+        A generator which follows the `cursor` of Disqus list API.
+        `list_method` is one of `get_threads_list`/`get_posts_list`,
+        and each page response is yielded once it arrives, so the caller
+        never has to hold more than one page in memory.
+        """
+        while True:
+            page = list_method(cursor=cursor, **kwargs)
+            yield page
+            page_cursor = page.get('cursor') or {}
+            if not page_cursor.get('hasNext'):
+                return
+            cursor = page_cursor['next']
+
+    def iter_rows(self, list_method, cursor_cache, offset=0, limit=None, **kwargs):
+        """
+        Yield at most `limit` rows of a listing starting from `offset`.
+        The request starts from the nearest known cursor in `cursor_cache`,
+        rows before `offset` are fetched in pages sized to end exactly at
+        `offset`, and the last page only asks for the remaining rows.
+        """
+        if limit is not None and limit <= 0:
+            return
+        position, cursor = cursor_cache.seek(kwargs, offset)
+        remaining = limit
+        while True:
+            skip = offset - position
+            if skip > 0:
+                page_limit = min(skip, self.page_size)
+            elif remaining is not None:
+                page_limit = min(remaining, self.page_size)
+            else:
+                page_limit = self.page_size
+            page = list_method(cursor=cursor, limit=page_limit, **kwargs)
+            rows = page['response']
+            position += len(rows)
+            page_cursor = page.get('cursor') or {}
+            has_next = page_cursor.get('hasNext')
+            if has_next:
+                cursor_cache.record(kwargs, position, page_cursor['next'])
+            for row in (rows[skip:] if skip > 0 else rows):
+                yield row
+                if remaining is not None:
+                    remaining -= 1
+                    if remaining == 0:
+                        return
+            if not has_next or not rows:
+                return
+            cursor = page_cursor['next']
+
+    def iter_threads(self, offset=0, limit=None, **kwargs):
+        return self.iter_rows(self.get_threads_list, thread_cursor_cache,
+                              offset, limit, **kwargs)
+
+    def iter_posts(self, offset=0, limit=None, **kwargs):
+        return self.iter_rows(self.get_posts_list, post_cursor_cache,
+                              offset, limit, **kwargs)
 
     @query_cache('thread')
     def get_thread(self, thread_id, *args, **kwargs):
@@ -90,7 +303,7 @@ class DisqusQuery(object):
             'api_secret': self.secret_key,
             'thread': thread_id
         }
-        return send_request_to_disqus(model_name, method_name, header, params)
+        return self.client.request(model_name, method_name, header, params)
 
     @query_cache('post')
     def get_post(self, post_id, *args, **kwargs):
@@ -101,7 +314,7 @@ class DisqusQuery(object):
             'api_secret': self.secret_key,
             'post': post_id
         }
-        return send_request_to_disqus(model_name, method_name, header, params)
+        return self.client.request(model_name, method_name, header, params)
 
     def change_thread_is_closed(self, thread_id, old_val, new_val):
         assert old_val != new_val
@@ -110,7 +323,7 @@ class DisqusQuery(object):
         else:
             return self.close_thread(thread_id)
 
-    @cache_clearer(['thread'])
+    @cache_patcher(['thread'], 'thread', fields={'isClosed': False})
     def open_thread(self, thread_id):
         model_name = 'threads'
         method_name = 'open'
@@ -120,9 +333,9 @@ class DisqusQuery(object):
             'thread': thread_id,
             'access_token': self.access_token
         }
-        return send_request_to_disqus(model_name, method_name, header, params)
+        return self.client.request(model_name, method_name, header, params)
 
-    @cache_clearer(['thread'])
+    @cache_patcher(['thread'], 'thread', fields={'isClosed': True})
     def close_thread(self, thread_id):
         model_name = 'threads'
         method_name = 'close'
@@ -132,9 +345,9 @@ class DisqusQuery(object):
             'thread': thread_id,
             'access_token': self.access_token
         }
-        return send_request_to_disqus(model_name, method_name, header, params)
+        return self.client.request(model_name, method_name, header, params)
 
-    @cache_clearer(['thread', 'post'])
+    @cache_patcher(['thread', 'post'], 'thread', removed=True)
     def delete_thread(self, thread_id):
         model_name = 'threads'
         method_name = 'remove'
@@ -144,9 +357,9 @@ class DisqusQuery(object):
             'thread': thread_id,
             'access_token': self.access_token
         }
-        return send_request_to_disqus(model_name, method_name, header, params)
+        return self.client.request(model_name, method_name, header, params)
 
-    @cache_clearer(['post'])
+    @cache_patcher(['post'], 'post', removed=True)
     def delete_post(self, post_id):
         model_name = 'posts'
         method_name = 'remove'
@@ -156,9 +369,9 @@ class DisqusQuery(object):
             'post': post_id,
             'access_token': self.access_token
         }
-        return send_request_to_disqus(model_name, method_name, header, params)
+        return self.client.request(model_name, method_name, header, params)
 
-    @cache_clearer(['thread', 'post'])
+    @cache_patcher(['thread', 'post'], 'thread', removed=True)
     def delete_threads(self, thread_ids):
         # thread_ids must be a list of thread id
         model_name = 'threads'
@@ -169,9 +382,9 @@ class DisqusQuery(object):
             'thread': thread_ids,
             'access_token': self.access_token
         }
-        return send_request_to_disqus(model_name, method_name, header, params)
+        return self.client.request(model_name, method_name, header, params)
 
-    @cache_clearer(['post'])
+    @cache_patcher(['post'], 'post', removed=True)
     def delete_posts(self, post_ids):
         # post_ids must be a list of post id
         model_name = 'posts'
@@ -182,9 +395,9 @@ class DisqusQuery(object):
             'post': post_ids,
             'access_token': self.access_token
         }
-        return send_request_to_disqus(model_name, method_name, header, params)
+        return self.client.request(model_name, method_name, header, params)
 
-    @cache_clearer(['thread'])
+    @cache_clearer(['thread', 'post'], restored='thread')
     def recover_thread(self, thread_id):
         model_name = 'threads'
         method_name = 'restore'
@@ -194,7 +407,7 @@ class DisqusQuery(object):
             'thread': thread_id,
             'access_token': self.access_token
         }
-        return send_request_to_disqus(model_name, method_name, header, params)
+        return self.client.request(model_name, method_name, header, params)
 
     def change_post_is_approved(self, post_id, old_val, new_val):
         assert old_val != new_val
@@ -203,7 +416,8 @@ class DisqusQuery(object):
         else:
             return self.approve_post(post_id)
 
-    @cache_clearer(['post'])
+    @cache_patcher(['post'], 'post', fields={'isApproved': True, 'isSpam': False},
+                   filtered_by=['include'])
     def approve_post(self, post_id):
         model_name = 'posts'
         method_name = 'approve'
@@ -213,10 +427,11 @@ class DisqusQuery(object):
             'post': post_id,
             'access_token': self.access_token
         }
-        return send_request_to_disqus(model_name, method_name, header, params)
+        return self.client.request(model_name, method_name, header, params)
 
 
-    @cache_clearer(['post'])
+    @cache_patcher(['post'], 'post', fields={'isApproved': False, 'isSpam': True},
+                   filtered_by=['include'])
     def spam_post(self, post_id):
         model_name = 'posts'
         method_name = 'spam'
@@ -226,9 +441,10 @@ class DisqusQuery(object):
             'post': post_id,
             'access_token': self.access_token
         }
-        return send_request_to_disqus(model_name, method_name, header, params)
+        return self.client.request(model_name, method_name, header, params)
 
-    @cache_clearer(['post'])
+    @cache_patcher(['post'], 'post',
+                   fields=lambda post_id, old_val, new_val: {'raw_message': new_val})
     def change_post_message(self, post_id, old_val, new_val):
         model_name = 'posts'
         method_name = 'update'
@@ -239,6 +455,97 @@ class DisqusQuery(object):
             'message': new_val,
             'access_token': self.access_token
         }
-        return send_request_to_disqus(model_name, method_name, header, params)
+        return self.client.request(model_name, method_name, header, params)
+
+    @cache_patcher(['post'], 'post', fields={'isApproved': True, 'isSpam': False},
+                   filtered_by=['include'])
+    def approve_posts(self, post_ids):
+        # post_ids must be a list of post id
+        model_name = 'posts'
+        method_name = 'approve'
+        header = "post"
+        params = {
+            'api_secret': self.secret_key,
+            'post': post_ids,
+            'access_token': self.access_token
+        }
+        return self.client.request(model_name, method_name, header, params)
+
+    @cache_patcher(['post'], 'post', fields={'isApproved': False, 'isSpam': True},
+                   filtered_by=['include'])
+    def spam_posts(self, post_ids):
+        # post_ids must be a list of post id
+        model_name = 'posts'
+        method_name = 'spam'
+        header = "post"
+        params = {
+            'api_secret': self.secret_key,
+            'post': post_ids,
+            'access_token': self.access_token
+        }
+        return self.client.request(model_name, method_name, header, params)
+
+    @cache_clearer(['post'], restored='post')
+    def restore_posts(self, post_ids):
+        # post_ids must be a list of post id
+        model_name = 'posts'
+        method_name = 'restore'
+        header = "post"
+        params = {
+            'api_secret': self.secret_key,
+            'post': post_ids,
+            'access_token': self.access_token
+        }
+        return self.client.request(model_name, method_name, header, params)
+
+    def run_in_chunks(self, method, ids, chunk_size=None, priority=None):
+        """
+        Call a write method which accepts a list of ids, ex. `delete_posts`,
+        with chunks of `ids` concurrently. The ids of a failed chunk are
+        retried one by one to find out which of them fail. The requests
+        are sent with `priority`, by default the one of the calling thread.
+        Return a dict of the failed ids and their exceptions.
+        """
+        chunk_size = chunk_size or self.page_size
+        chunks = [list(ids[i:i + chunk_size]) for i in range(0, len(ids), chunk_size)]
+        if priority is None:
+            priority = current_priority(WRITE)
+
+        def run(chunk):
+            # The priority of a thread isn't inherited by the pool workers
+            with request_priority(priority):
+                return run_chunk(chunk)
+
+        def run_chunk(chunk):
+            try:
+                method(chunk)
+                return {}
+            except (RequestError, DISQUSAPIError) as e:
+                if len(chunk) == 1:
+                    return {chunk[0]: e}
+            failures = {}
+            for entity_id in chunk:
+                try:
+                    method([entity_id])
+                except (RequestError, DISQUSAPIError) as e:
+                    failures[entity_id] = e
+            return failures
+
+        if len(chunks) <= 1:
+            results = [run(chunk) for chunk in chunks]
+        else:
+            pool = ThreadPool(min(len(chunks), self.client.pool_size))
+            try:
+                results = pool.map(cache_registry.bind(run), chunks)
+            finally:
+                pool.close()
+                pool.join()
+        failures = {}
+        for result in results:
+            failures.update(result)
+        return failures
 
 disqus_query = DisqusQuery()
+
+thread_cursor_cache = CursorCache('thread', DisqusQuery.__dict__['get_threads_list'])
+post_cursor_cache = CursorCache('post', DisqusQuery.__dict__['get_posts_list'])
@@ -0,0 +1,14 @@
+class RequestError(Exception):
+    pass
+
+
+class RateLimitExceeded(RequestError):
+    pass
+
+
+class DISQUSAPIError(Exception):
+    pass
+
+
+class ConcurrentModificationError(Exception):
+    pass
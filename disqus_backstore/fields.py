@@ -0,0 +1,50 @@
+from django.db import models
+from django.db.models.fields.related_descriptors import ForwardManyToOneDescriptor
+
+
+class DeferredForwardManyToOneDescriptor(ForwardManyToOneDescriptor):
+    """
+    A forward many-to-one descriptor which resolves the related object
+    on first access only. The iterables only save the raw related id
+    on each instance, and put the instances built from the same page
+    into one shared pending list. The first access resolves every pending
+    instance in the list with one `in_bulk` lookup.
+    """
+    def __init__(self, field_with_rel):
+        super(DeferredForwardManyToOneDescriptor, self).__init__(field_with_rel)
+        self.pending_name = '_%s_pending' % self.field.name
+
+    def __get__(self, instance, instance_type=None):
+        if instance is None:
+            return self
+        if not self.is_cached(instance):
+            self.resolve(instance)
+        return super(DeferredForwardManyToOneDescriptor, self).__get__(instance, instance_type)
+
+    def defer(self, instances):
+        pending = list(instances)
+        for instance in pending:
+            setattr(instance, self.pending_name, pending)
+
+    def resolve(self, instance):
+        pending = getattr(instance, self.pending_name, None) or [instance]
+        pending = [obj for obj in pending if not self.is_cached(obj)]
+        related_ids = set(getattr(obj, self.field.attname) for obj in pending)
+        related_ids.discard(None)
+        related_model = self.field.remote_field.model
+        related_objs = related_model._default_manager.in_bulk(related_ids) if related_ids else {}
+        for obj in pending:
+            # Missing related object is cached as None, so the
+            # `RelatedObjectDoesNotExist` is raised by the parent descriptor.
+            setattr(obj, self.cache_name, related_objs.get(getattr(obj, self.field.attname)))
+            obj.__dict__.pop(self.pending_name, None)
+
+
+class DeferredForeignKey(models.ForeignKey):
+    """
+    `ForeignKey` whose related object is resolved lazily
+    and in batch by `DeferredForwardManyToOneDescriptor`.
+    """
+    def contribute_to_class(self, cls, name, *args, **kwargs):
+        super(DeferredForeignKey, self).contribute_to_class(cls, name, *args, **kwargs)
+        setattr(cls, self.name, DeferredForwardManyToOneDescriptor(self))
@@ -0,0 +1,309 @@
+"""
+Compile the `filter`/`exclude`/`complex_filter` arguments
+of `DisqusQuerySet` into one predicate of the raw Disqus API rows.
+The lookup values are prepared once when compiling, so checking a row
+is only a few function calls whatever the number of rows.
+The `order_by` arguments which Disqus can't sort are compiled
+into a sort key of the rows in the same way.
+"""
+
+import heapq
+import operator
+
+from django.conf import settings
+from django.core.exceptions import FieldError
+from django.db.models import Model, Q
+from django.db.models.constants import LOOKUP_SEP
+from django.utils import six, timezone
+from django.utils.dateparse import parse_datetime
+
+
+def _to_text(value):
+    return value if value is None else six.text_type(value)
+
+
+def _to_int(value):
+    return value if value is None else int(value)
+
+
+def _to_bool(value):
+    return value if value is None else bool(value)
+
+
+def to_datetime(value):
+    """
+    Parse the datetime string of Disqus API, which is always in UTC.
+    """
+    if value is None:
+        return None
+    value = parse_datetime(value)
+    if value is not None and settings.USE_TZ and timezone.is_naive(value):
+        value = timezone.make_aware(value, timezone.utc)
+    return value
+
+
+def to_disqus_datetime(value):
+    if timezone.is_aware(value):
+        value = timezone.make_naive(value, timezone.utc)
+    return value.strftime('%Y-%m-%dT%H:%M:%S')
+
+
+class RowField(object):
+    """
+    The mapping between a model field and the key of Disqus API row.
+    """
+    def __init__(self, model_field, key):
+        self.model_field = model_field
+        self.key = key
+        target_field = getattr(model_field, 'target_field', model_field)
+        internal_type = target_field.get_internal_type()
+        if internal_type in ('BigIntegerField', 'IntegerField', 'AutoField'):
+            self.to_row_python = _to_int
+        elif internal_type in ('BooleanField', 'NullBooleanField'):
+            self.to_row_python = _to_bool
+        elif internal_type == 'DateTimeField':
+            self.to_row_python = to_datetime
+        else:
+            self.to_row_python = _to_text
+        self.target_field = target_field
+
+    def get_value(self, row):
+        return self.to_row_python(row.get(self.key))
+
+    def prepare(self, value):
+        if isinstance(value, Model):
+            value = value.pk
+        if value is None:
+            return None
+        value = self.target_field.to_python(value)
+        if (self.to_row_python is to_datetime and settings.USE_TZ and
+                timezone.is_naive(value)):
+            value = timezone.make_aware(value, timezone.get_default_timezone())
+        return value
+
+
+def get_row_fields(model, row_keys):
+    """
+    Return `name -> RowField` for model fields in `row_keys`, which maps
+    field name to the row key. `pk` and the `attname` of foreign keys
+    (ex. `thread_id`) are added as aliases.
+    """
+    row_fields = dict()
+    for name, key in row_keys.items():
+        model_field = model._meta.get_field(name)
+        row_field = RowField(model_field, key)
+        row_fields[name] = row_field
+        row_fields[model_field.attname] = row_field
+        if model_field.primary_key:
+            row_fields['pk'] = row_field
+    return row_fields
+
+
+def _exact(get_value, value):
+    return lambda row: get_value(row) == value
+
+
+def _iexact(get_value, value):
+    value = value.lower()
+    return lambda row: (get_value(row) or '').lower() == value
+
+
+def _in(get_value, values):
+    return lambda row: get_value(row) in values
+
+
+def _contains(get_value, value):
+    return lambda row: value in (get_value(row) or '')
+
+
+def _icontains(get_value, value):
+    value = value.lower()
+    return lambda row: value in (get_value(row) or '').lower()
+
+
+def _startswith(get_value, value):
+    return lambda row: (get_value(row) or '').startswith(value)
+
+
+def _istartswith(get_value, value):
+    value = value.lower()
+    return lambda row: (get_value(row) or '').lower().startswith(value)
+
+
+def _comparison(op):
+    def compile_lookup(get_value, value):
+        def predicate(row):
+            row_value = get_value(row)
+            return row_value is not None and op(row_value, value)
+        return predicate
+    return compile_lookup
+
+
+def _isnull(get_value, value):
+    if value:
+        return lambda row: get_value(row) is None
+    return lambda row: get_value(row) is not None
+
+
+LOOKUPS = {
+    'exact': _exact,
+    'iexact': _iexact,
+    'in': _in,
+    'contains': _contains,
+    'icontains': _icontains,
+    'startswith': _startswith,
+    'istartswith': _istartswith,
+    'gt': _comparison(operator.gt),
+    'gte': _comparison(operator.ge),
+    'lt': _comparison(operator.lt),
+    'lte': _comparison(operator.le),
+    'isnull': _isnull,
+}
+
+TEXT_LOOKUPS = ('iexact', 'contains', 'icontains', 'startswith', 'istartswith')
+
+
+def split_lookup(query_string, row_fields):
+    """
+    Split `query_string` into `(RowField, lookup_name)`.
+    Traversing the primary key of a relation (ex. `thread__id`)
+    is the same as using the relation itself.
+    """
+    parts = query_string.split(LOOKUP_SEP)
+    lookup_name = 'exact'
+    if len(parts) > 1 and parts[-1] in LOOKUPS:
+        lookup_name = parts.pop()
+    if len(parts) == 2 and parts[1] in ('id', 'pk'):
+        parts.pop()
+    if len(parts) != 1 or parts[0] not in row_fields:
+        raise FieldError("Cannot resolve keyword '%s' into field. Choices are: %s" % (
+            query_string, ', '.join(sorted(row_fields))))
+    return row_fields[parts[0]], lookup_name
+
+
+def compile_lookup(query_string, value, row_fields):
+    row_field, lookup_name = split_lookup(query_string, row_fields)
+    get_value = row_field.get_value
+    if lookup_name == 'isnull':
+        return _isnull(get_value, bool(value))
+    if lookup_name == 'in':
+        value = frozenset(row_field.prepare(v) for v in value)
+    elif lookup_name in TEXT_LOOKUPS:
+        value = six.text_type(value)
+    else:
+        value = row_field.prepare(value)
+    if value is None and lookup_name == 'exact':
+        return _isnull(get_value, True)
+    return LOOKUPS[lookup_name](get_value, value)
+
+
+def _negate(predicate):
+    return lambda row: not predicate(row)
+
+
+def _all(predicates):
+    if len(predicates) == 1:
+        return predicates[0]
+
+    def predicate(row):
+        for p in predicates:
+            if not p(row):
+                return False
+        return True
+    return predicate
+
+
+def _any(predicates):
+    if len(predicates) == 1:
+        return predicates[0]
+
+    def predicate(row):
+        for p in predicates:
+            if p(row):
+                return True
+        return False
+    return predicate
+
+
+def compile_q(q, row_fields):
+    predicates = []
+    for child in q.children:
+        if isinstance(child, Q):
+            predicates.append(compile_q(child, row_fields))
+        else:
+            predicates.append(compile_lookup(child[0], child[1], row_fields))
+    if not predicates:
+        predicate = lambda row: True
+    elif q.connector == Q.OR:
+        predicate = _any(predicates)
+    else:
+        predicate = _all(predicates)
+    return _negate(predicate) if q.negated else predicate
+
+
+def compile_filters(query_objs, row_fields):
+    """
+    Compile a list of `Query`/`Q` objects into one predicate of a row.
+    All of them have to be met.
+    """
+    predicates = []
+    for q in query_objs:
+        if isinstance(q, Q):
+            predicates.append(compile_q(q, row_fields))
+        else:
+            predicate = compile_lookup(q.query_string, q.value, row_fields)
+            predicates.append(_negate(predicate) if q.negate else predicate)
+    if not predicates:
+        return lambda row: True
+    return _all(predicates)
+
+
+class SortKey(object):
+    """
+    Sort key of a row for orderings mixing ascending and descending
+    fields. `None` is smaller than any other value.
+    """
+    __slots__ = ('values', 'descending')
+
+    def __init__(self, values, descending):
+        self.values = values
+        self.descending = descending
+
+    def __lt__(self, other):
+        for a, b, descending in zip(self.values, other.values, self.descending):
+            if a == b:
+                continue
+            if a is None:
+                return not descending
+            if b is None:
+                return descending
+            return a > b if descending else a < b
+        return False
+
+
+def compile_ordering(ordering, row_fields):
+    """
+    Compile `order_by` field names into a sort key function of a row.
+    """
+    getters = []
+    descending = []
+    for field_name in ordering:
+        name = field_name.lstrip('-')
+        if name not in row_fields:
+            raise FieldError("Cannot resolve keyword '%s' into field. Choices are: %s" % (
+                name, ', '.join(sorted(row_fields))))
+        getters.append(row_fields[name].get_value)
+        descending.append(field_name.startswith('-'))
+    descending = tuple(descending)
+    return lambda row: SortKey(tuple(get_value(row) for get_value in getters), descending)
+
+
+def sort_rows(rows, key, low=0, high=None):
+    """
+    Sort `rows` and return the `[low:high]` slice of them.
+    With an upper bound only the top `high` rows are kept in a heap,
+    so the whole listing is never sorted or held at once.
+    """
+    if high is None:
+        return sorted(rows, key=key)[low:]
+    return heapq.nsmallest(high, rows, key=key)[low:]
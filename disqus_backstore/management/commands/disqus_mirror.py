@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from disqus_backstore.disqus_interface import disqus_query
+from disqus_backstore.mirror import get_mirror
+from disqus_backstore.models import Post, Thread
+
+
+class Command(BaseCommand):
+    help = "Copy the Disqus threads and posts of the forum into the local mirror tables."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help="The number of rows saved in one transaction.")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        count = get_mirror(Thread).sync(disqus_query.iter_threads(), batch_size)
+        self.stdout.write("Mirrored {count} threads.".format(count=count))
+        count = get_mirror(Post).sync(disqus_query.iter_posts(), batch_size)
+        self.stdout.write("Mirrored {count} posts.".format(count=count))
@@ -0,0 +1,24 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from disqus_backstore.sync import DeltaSync
+
+
+class Command(BaseCommand):
+    help = "Apply the Disqus threads and posts created since the last sync."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=None,
+                            help="Keep syncing every INTERVAL seconds.")
+
+    def handle(self, *args, **options):
+        interval = options['interval']
+        while True:
+            for entity in ('thread', 'post'):
+                count = DeltaSync(entity).run()
+                if count:
+                    self.stdout.write("Synced {count} {entity}s.".format(count=count, entity=entity))
+            if interval is None:
+                return
+            time.sleep(interval)
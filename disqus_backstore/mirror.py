@@ -0,0 +1,179 @@
+"""
+A local SQL mirror of the Disqus threads and posts.
+
+`python manage.py disqus_mirror` copies the forum into the `ThreadMirror`
+and `PostMirror` tables. With `DISQUS_READ_FROM_MIRROR = True` the
+querysets of `Thread`/`Post` are answered by the mirror tables, while
+the writes still go to Disqus and are applied to the mirror afterwards.
+"""
+import itertools
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Model, Q
+from django.utils import timezone
+
+from .disqus_interface import DISQUSAPIError, disqus_query
+from .filters import get_row_fields
+from .utils import cache_registry
+
+# model -> `Mirror`
+mirrors = dict()
+
+
+def read_from_mirror():
+    return getattr(settings, 'DISQUS_READ_FROM_MIRROR', False)
+
+
+def get_mirror(model):
+    return mirrors[model]
+
+
+def to_mirror_value(value):
+    if isinstance(value, Model):
+        return value.pk
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return [to_mirror_value(v) for v in value]
+    return value
+
+
+def to_mirror_q(q):
+    """
+    Convert a `Q` or `Query` of the queryset to a `Q` of the mirror model.
+    The field names are the same, only model instances are replaced
+    by their primary keys.
+    """
+    if isinstance(q, Q):
+        mirror_q = Q()
+        mirror_q.connector = q.connector
+        mirror_q.negated = q.negated
+        mirror_q.children = [
+            to_mirror_q(child) if isinstance(child, Q) else (child[0], to_mirror_value(child[1]))
+            for child in q.children
+        ]
+        return mirror_q
+    mirror_q = Q(**{q.query_string: to_mirror_value(q.value)})
+    return ~mirror_q if q.negate else mirror_q
+
+
+def get_mirror_queryset(queryset):
+    """
+    Return the queryset of the mirror model with the filters,
+    ordering and slice of a `DisqusQuerySet`.
+    """
+    mirror_queryset = get_mirror(queryset.model).model._default_manager.all()
+    for q in queryset.query_objs:
+        mirror_queryset = mirror_queryset.filter(to_mirror_q(q))
+    # Like Disqus listings, the newest first by default
+    mirror_queryset = mirror_queryset.order_by(*(queryset._ordering or ['-id']))
+    if queryset._high_mark is not None:
+        return mirror_queryset[queryset._low_mark:queryset._high_mark]
+    return mirror_queryset[queryset._low_mark:]
+
+
+class Mirror(object):
+    """
+    The mirror table of `entity`. It's registered in `cache_registry`
+    like a query cache, so the changes of write operations are applied
+    to the table when `DISQUS_READ_FROM_MIRROR` is on.
+    """
+    # The number of ids in one `IN (...)` query, SQLite limits the
+    # bound variables to 999 by default
+    patch_batch_size = 500
+
+    def __init__(self, entity, model, source_model, row_keys):
+        self.entity = entity
+        self.model = model
+        self.source_model = source_model
+        self.row_keys = row_keys
+        # row key -> attname of the mirror model
+        self.attnames = dict(
+            (key, source_model._meta.get_field(name).attname) for name, key in row_keys.items()
+        )
+        # (attname of the mirror model, value getter of the row),
+        # built once for all the rows saved by `save_rows`
+        row_fields = get_row_fields(source_model, row_keys)
+        self.getters = [
+            (self.attnames[key], row_fields[name].get_value) for name, key in row_keys.items()
+        ]
+        mirrors[source_model] = self
+        cache_registry.register(entity, self)
+
+    def to_values(self, row):
+        return dict((attname, get_value(row)) for attname, get_value in self.getters)
+
+    def save_rows(self, rows, mirrored_at):
+        objs = [self.model(mirrored_at=mirrored_at, **self.to_values(row)) for row in rows]
+        with transaction.atomic():
+            self.model._default_manager.filter(pk__in=[obj.pk for obj in objs]).delete()
+            self.model._default_manager.bulk_create(objs)
+
+    def sync(self, rows, batch_size=500):
+        """
+        Save every row of the whole listing, then remove the mirrored
+        rows which aren't in the listing anymore.
+        Return the number of saved rows.
+        """
+        started_at = timezone.now()
+        rows = iter(rows)
+        count = 0
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                break
+            self.save_rows(batch, started_at)
+            count += len(batch)
+        self.model._default_manager.filter(mirrored_at__lt=started_at).delete()
+        return count
+
+    def clear(self):
+        # The change is unknown, it's picked up by the next `disqus_mirror`
+        pass
+
+    def restore(self, entity, ids):
+        """
+        Mirror the restored entities again, or the posts of restored
+        threads. Like `patch`, only when the mirror is read.
+        """
+        if not read_from_mirror():
+            return
+        rows = []
+        if entity == self.entity:
+            get_detail = disqus_query.get_thread if entity == 'thread' else disqus_query.get_post
+            for entity_id in ids:
+                try:
+                    rows.append(get_detail(entity_id)['response'])
+                except DISQUSAPIError:
+                    # It's deleted again or never existed
+                    pass
+        elif entity == 'thread':
+            for thread_id in ids:
+                for page in disqus_query.iter_pages(disqus_query.get_posts_list, thread_id=thread_id):
+                    rows.extend(page['response'])
+        if rows:
+            self.save_rows(rows, timezone.now())
+
+    def patch(self, change):
+        if not read_from_mirror():
+            return
+        ids = [int(entity_id) for entity_id in change.ids]
+        batch_size = self.patch_batch_size
+        with transaction.atomic():
+            for i in range(0, len(ids), batch_size):
+                self.patch_batch(change, ids[i:i + batch_size])
+
+    def patch_batch(self, change, ids):
+        manager = self.model._default_manager
+        if change.entity == self.entity:
+            if change.removed:
+                manager.filter(pk__in=ids).delete()
+                return
+            values = dict(
+                (self.attnames[key], value) for key, value in change.fields.items()
+                if key in self.attnames
+            )
+            if values:
+                manager.filter(pk__in=ids).update(**values)
+        elif change.removed and change.entity == 'thread':
+            # The posts of removed threads
+            manager.filter(thread_id__in=ids).delete()
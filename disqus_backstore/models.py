@@ -2,7 +2,10 @@ from __future__ import unicode_literals
 
 from django.db import models
 
+from .fields import DeferredForeignKey
 from .manager import ThreadManager, PostManager
+from .mirror import Mirror
+from .query import ThreadQuerySet, PostQuerySet
 
 
 class Thread(models.Model):
@@ -15,6 +18,7 @@ class Thread(models.Model):
     is_closed = models.BooleanField()
     link = models.URLField()
     title = models.CharField(max_length=100)
+    created_at = models.DateTimeField(null=True, editable=False)
 
     def delete(self, using=None, keep_parents=False):
         self.__class__._default_manager.delete(self)
@@ -44,7 +48,8 @@ class Post(models.Model):
     id = models.BigIntegerField(primary_key=True)
     is_approved = models.BooleanField()
     message = models.TextField(blank=True)
-    thread = models.ForeignKey(Thread)
+    thread = DeferredForeignKey(Thread)
+    created_at = models.DateTimeField(null=True, editable=False)
 
     def delete(self, using=None, keep_parents=False):
         self.__class__._default_manager.delete(self)
@@ -63,3 +68,57 @@ class Post(models.Model):
 
     def __unicode__(self):
         return self.message if self.message else "Empty message"
+
+
+class ThreadMirror(models.Model):
+    """
+    The local copy of a Disqus thread, see `disqus_backstore.mirror`.
+    """
+    forum = models.CharField(max_length=100, db_index=True)
+    id = models.BigIntegerField(primary_key=True)
+    is_closed = models.BooleanField(default=False)
+    link = models.URLField(max_length=500)
+    title = models.CharField(max_length=255)
+    created_at = models.DateTimeField(null=True, db_index=True)
+    mirrored_at = models.DateTimeField(db_index=True)
+
+
+class PostMirror(models.Model):
+    """
+    The local copy of a Disqus post, see `disqus_backstore.mirror`.
+    """
+    forum = models.CharField(max_length=100, db_index=True)
+    id = models.BigIntegerField(primary_key=True)
+    is_approved = models.BooleanField(default=False, db_index=True)
+    message = models.TextField(blank=True)
+    # The thread may not be mirrored yet
+    thread = models.ForeignKey(ThreadMirror, db_constraint=False, on_delete=models.DO_NOTHING,
+                               related_name='+')
+    created_at = models.DateTimeField(null=True, db_index=True)
+    mirrored_at = models.DateTimeField(db_index=True)
+
+
+Mirror('thread', ThreadMirror, Thread, ThreadQuerySet.row_keys)
+Mirror('post', PostMirror, Post, PostQuerySet.row_keys)
+
+
+class SyncState(models.Model):
+    """
+    The high-water mark of the incremental sync of a forum, see
+    `disqus_backstore.sync`. `cursor` is set while a sync is in progress,
+    so it can be resumed after a crash.
+    """
+    forum = models.CharField(max_length=100)
+    entity = models.CharField(max_length=10)
+    # The `since` of the current sync
+    since = models.DateTimeField(null=True)
+    cursor = models.CharField(max_length=100, blank=True)
+    # The newest `createdAt` which has been applied
+    last_seen = models.DateTimeField(null=True)
+    # The comma separated ids of the applied rows created at `last_seen`,
+    # `since` is inclusive so they're listed again by the next sync
+    last_seen_ids = models.TextField(blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('forum', 'entity')
@@ -4,11 +4,35 @@ the same interface in django `QuerySet` class,
 ex. the implementation of filter/get method.
 """
 
-import copy
+import itertools
+from multiprocessing.pool import ThreadPool
 
+from django.conf import settings
+from django.core.exceptions import FieldError
+from django.db.models import Q, signals
+from django.db.models.base import ModelState
 from django.db.models.query import BaseIterable
 
-from .disqus_interface import disqus_query
+try:
+    from django.db.models.query_utils import deferred_class_factory
+except ImportError:
+    # Django 1.10+ loads the deferred fields of any model
+    deferred_class_factory = None
+
+from .disqus_interface import DISQUSAPIError, DisqusQuery, disqus_query
+from .exceptions import ConcurrentModificationError
+from .filters import (compile_filters, compile_ordering, get_row_fields, sort_rows,
+                      split_lookup, to_datetime, to_disqus_datetime)
+from .mirror import get_mirror_queryset, read_from_mirror
+from .scheduler import WRITE, current_priority
+from .search import search_index
+from .utils import CountCache, cache_registry, saving_skipped
+
+# The number of rows of counted listings
+count_cache = CountCache(['thread', 'post'])
+
+# (model, loaded attnames) -> the model class with deferred fields
+deferred_models = dict()
 
 
 class Query(object):
@@ -18,78 +42,264 @@ class Query(object):
         self.negate = negate
 
 
-def get_thread_from_thread_list(id, thread_list):
-    for thread in thread_list:
-        if str(thread.id) == id:
-            return thread
-    return None
-
-def meet_querys(data, query_objs):
-    for q in query_objs:
-        if q.query_string == 'pk' or q.query_string == 'id':
-            if q.negate and data['id'] == str(q.value):
-                return False
-            elif not q.negate and data['id'] != str(q.value):
-                return False
-        # It's a dirty workaround for thread delete view to filter Post
-        # We should have a class to parse the filter string used in admin
-        if q.query_string == 'thread__in':
-            thread_ids = [str(obj.id) for obj in q.value]
-            if q.negate and data['thread'] in thread_ids:
-                return False
-            elif not q.negate and data['thread'] not in thread_ids:
-                return False
-        if q.query_string == 'pk__in':
-            ids = q.value
-            if q.negate and data['id'] in ids:
-                return False
-            elif not q.negate and data['id'] not in ids:
-                return False
-    return True
-
-
-class ThreadIterable(BaseIterable):
+def is_pk_ordering(ordering):
+    return all(o.lstrip('-') in ('id', 'pk') for o in ordering if o != '?')
+
+
+def describe_query_obj(q):
+    """A hashable description of a `Q` or `Query`, for cache keys"""
+    if isinstance(q, Q):
+        return str(q)
+    return (q.query_string, repr(q.value), q.negate)
+
+
+class QueryPlan(object):
+    """
+    The result of `DisqusQuerySet.plan`. `params` are sent to the Disqus
+    list API, `pk` is fetched by the details API, and only `query_objs`
+    are left to be evaluated locally.
+    """
+    def __init__(self):
+        self.params = dict()
+        self.pk = None
+        self.pk_query = None
+        # The primary keys fetched one by one by the details API
+        self.pks = None
+        self.pks_query = None
+        self.query_objs = []
+        # The ordering which has to be sorted locally
+        self.ordering = []
+
+
+class DisqusIterable(BaseIterable):
+    """
+    Base iterable which pushes the queryset plan down to the Disqus API.
+    Without local filters the slice becomes a bounded cursor fetch,
+    otherwise rows are streamed until the slice of matched rows is filled.
+    """
+    def fetch_rows(self, **kwargs):
+        raise NotImplementedError
+
+    def fetch_detail(self, pk):
+        raise NotImplementedError
+
+    def fetch_remote_detail(self, pk):
+        """
+        Like `fetch_detail`, but the row is always requested from Disqus,
+        not served by the query cache.
+        """
+        get_detail = DisqusQuery.__dict__['get_{entity}'.format(entity=self.entity)].func
+        try:
+            return [get_detail(self.queryset.query, pk)['response']]
+        except DISQUSAPIError:
+            return []
+
+    def fetch_details(self, pks):
+        """
+        Fetch the details of `pks` concurrently.
+        """
+        if not pks:
+            return []
+        pool = ThreadPool(min(len(pks), self.queryset.query.client.pool_size))
+        try:
+            details = pool.map(self.fetch_detail, pks)
+        finally:
+            pool.close()
+            pool.join()
+        missing = [pk for pk, rows in zip(pks, details) if not rows]
+        if missing and search_index.enabled:
+            # Ex. the ids found by the search index were removed on Disqus
+            search_index.discard(self.entity, missing)
+        return [row for rows in details for row in rows]
+
+    def build(self, rows):
+        raise NotImplementedError
+
     def __iter__(self):
+        if read_from_mirror():
+            return self.build_from_mirror(get_mirror_queryset(self.queryset))
+        return self.build_rows(self.rows())
+
+    def build_rows(self, rows):
+        """
+        Turn the fetched rows into the results, which are dicts or tuples
+        for `values()`/`values_list()`, and partially loaded instances
+        for `only()`/`defer()`.
+        """
         queryset = self.queryset
-        #processing query string, currently only processing primary key
-        rawdata = queryset.query.get_threads_list()
-        for thread in rawdata['response']:
-            if meet_querys(thread, queryset.query_objs):
-                 obj = queryset.create(
-                     id=int(thread.get('id')),
-                     title=thread.get('title'),
-                     link=thread.get('link'),
-                     forum=thread.get('forum'),
-                     is_closed=thread.get('isClosed'),
-                 )
-        # Dirty hack for unique check in admin changeform view
-                 obj._state.adding = False
-                 yield obj
-
-
-class PostIterable(BaseIterable):
-    def __iter__(self):
+        if queryset._fields is not None:
+            return self.build_values(rows)
+        if queryset.get_loaded_attnames() != queryset.get_attnames():
+            return self.build_partial(rows)
+        return self.build(rows)
+
+    def build_values(self, rows):
+        queryset = self.queryset
+        row_fields = queryset.get_row_fields()
+        getters = [row_fields[name].get_value for name in queryset._fields]
+        if queryset._values_as == 'flat':
+            get_value = getters[0]
+            return (get_value(row) for row in rows)
+        if queryset._values_as == 'tuple':
+            return (tuple([get_value(row) for get_value in getters]) for row in rows)
+        return (dict(zip(queryset._fields, [get_value(row) for get_value in getters])) for row in rows)
+
+    def build_partial(self, rows):
+        queryset = self.queryset
+        row_fields = queryset.get_row_fields()
+        attnames = queryset.get_loaded_attnames()
+        getters = [row_fields[attname].get_value for attname in attnames]
+        for row in rows:
+            yield queryset.from_values([get_value(row) for get_value in getters], attnames)
+
+    def build_from_mirror(self, mirror_queryset):
+        queryset = self.queryset
+        if queryset._fields is not None:
+            if queryset._values_as == 'dict':
+                return mirror_queryset.values(*queryset._fields).iterator()
+            return mirror_queryset.values_list(
+                *queryset._fields, flat=queryset._values_as == 'flat').iterator()
+        attnames = queryset.get_loaded_attnames()
+        return (queryset.from_values(values, attnames)
+                for values in mirror_queryset.values_list(*attnames).iterator())
+
+    def source(self):
+        """
+        Decide how the rows of the queryset are fetched. Return
+        `(method_name, kwargs, query_objs, ordering)`, where `method_name`
+        is `fetch_rows` or `fetch_detail`, and `query_objs` is None when
+        the fetched rows are exactly the result.
+        """
+        queryset = self.queryset
+        low, high = queryset._low_mark, queryset._high_mark
+        plan = queryset.plan()
+        if plan.pk is not None:
+            # The other pushed lookups don't apply to the details API
+            query_objs = [q for q in queryset.query_objs if q is not plan.pk_query]
+            return 'fetch_detail', {'pk': plan.pk}, query_objs, []
+        elif plan.pks is not None:
+            # Only the details of the sliced page of ids are fetched
+            ordering = [o for o in queryset._ordering if o != '?']
+            pks = plan.pks[::-1] if ordering and ordering[0].startswith('-') else plan.pks
+            return 'fetch_details', {'pks': pks[low:high]}, None, []
+        elif not plan.query_objs and not plan.ordering:
+            limit = None if high is None else high - low
+            return 'fetch_rows', dict(plan.params, offset=low, limit=limit), None, []
+        return 'fetch_rows', plan.params, plan.query_objs, plan.ordering
+
+    def rows(self, source=None):
+        method_name, kwargs, query_objs, ordering = source or self.source()
+        rows = search_index.observe(self.entity, getattr(self, method_name)(**kwargs))
+        return self.select_rows(rows, query_objs, ordering)
+
+    def select_rows(self, rows, query_objs, ordering):
+        if query_objs is None:
+            return rows
+        queryset = self.queryset
+        low, high = queryset._low_mark, queryset._high_mark
+        predicate = queryset.compile_filters(query_objs)
+        rows = (row for row in rows if predicate(row))
+        if ordering:
+            key = compile_ordering(ordering, queryset.get_row_fields())
+            return sort_rows(rows, key, low, high)
+        return itertools.islice(rows, low, high)
+
+
+class ThreadIterable(DisqusIterable):
+    entity = 'thread'
+
+    def fetch_rows(self, thread_ids=None, offset=0, limit=None, **kwargs):
+        query = self.queryset.query
+        if thread_ids is None:
+            return query.iter_threads(offset=offset, limit=limit, **kwargs)
+        # `threads/list` accepts one page of thread ids per request
+        page_size = query.page_size
+        rows = itertools.chain.from_iterable(
+            query.iter_threads(thread_ids=thread_ids[i:i + page_size], **kwargs)
+            for i in range(0, len(thread_ids), page_size)
+        )
+        return itertools.islice(rows, offset, None if limit is None else offset + limit)
+
+    def fetch_detail(self, pk):
+        try:
+            return [self.queryset.query.get_thread(pk)['response']]
+        except DISQUSAPIError:
+            return []
+
+    def build(self, rows):
         queryset = self.queryset
-        #processing query string, currently only processing primary key
-        rawdata = queryset.query.get_posts_list()
-        #hack for reduce redundant thread list request
-        thread_field = queryset.model._meta.get_field('thread')
-        thread_list = list(thread_field.remote_field.model.objects.all())
-        for post in rawdata['response']:
-            if meet_querys(post, queryset.query_objs):
-                thread = get_thread_from_thread_list(post['thread'], thread_list)
-                obj = queryset.create(
-                    id=int(post.get('id')),
-                    forum=post.get('forum'),
-                    is_approved=post.get('isApproved'),
-                    message=post.get('raw_message'),
-                    thread=thread,
-                )
-                obj._state.adding = False
+        for thread in rows:
+            # In the order of `Thread` fields
+            yield queryset.from_values((
+                thread.get('forum'),
+                int(thread.get('id')),
+                thread.get('isClosed'),
+                thread.get('link'),
+                thread.get('title'),
+                to_datetime(thread.get('createdAt')),
+            ))
+
+
+class PostIterable(DisqusIterable):
+    entity = 'post'
+
+    def fetch_rows(self, **kwargs):
+        return self.queryset.query.iter_posts(**kwargs)
+
+    def fetch_detail(self, pk):
+        try:
+            return [self.queryset.query.get_post(pk)['response']]
+        except DISQUSAPIError:
+            return []
+
+    def build(self, rows):
+        return self.defer_threads(self.create_post(post) for post in rows)
+
+    def build_partial(self, rows):
+        objs = super(PostIterable, self).build_partial(rows)
+        if 'thread_id' not in self.queryset.get_loaded_attnames():
+            return objs
+        return self.defer_threads(objs)
+
+    def build_from_mirror(self, mirror_queryset):
+        objs = super(PostIterable, self).build_from_mirror(mirror_queryset)
+        queryset = self.queryset
+        if queryset._fields is not None or 'thread_id' not in queryset.get_loaded_attnames():
+            return objs
+        return self.defer_threads(objs)
+
+    def create_post(self, post):
+        # Only the raw thread id is kept, the thread is resolved
+        # with the other posts of this page on first access.
+        queryset = self.queryset
+        # In the order of `Post` fields
+        return queryset.from_values((
+            post.get('forum'),
+            int(post.get('id')),
+            post.get('isApproved'),
+            post.get('raw_message'),
+            int(post.get('thread')),
+            to_datetime(post.get('createdAt')),
+        ))
+
+    def defer_threads(self, objs):
+        queryset = self.queryset
+        thread_descriptor = queryset.model.thread
+        objs = iter(objs)
+        while True:
+            page = list(itertools.islice(objs, queryset.query.page_size))
+            if not page:
+                return
+            thread_descriptor.defer(page)
+            for obj in page:
                 yield obj
 
 
 class DisqusQuerySet(object):
+    # model field name -> key of the Disqus API row
+    row_keys = {}
+    _row_fields = None
+    _attnames = None
 
     ##############
     #Magic Method#
@@ -102,15 +312,42 @@ class DisqusQuerySet(object):
         self._prefetch_related_lookups = []
         self.query_objs = []
         self._result_cache = None
+        self._low_mark = 0
+        self._high_mark = None
+        self._ordering = []
+        # The field names of `values()`/`values_list()`,
+        # which return them as a 'dict', 'tuple' or 'flat' value
+        self._fields = None
+        self._values_as = None
+        # Like `django.db.models.sql.Query.deferred_loading`,
+        # the field names and whether they're deferred or the only loaded
+        self._deferred_loading = (frozenset(), True)
 
     def __iter__(self):
         self._fetch_all()
         return iter(self._result_cache)
 
-    def __getitem__(self, i):
-        if self._result_cache is None:
-            self._fetch_all()
-        return self._result_cache[i]
+    def __aiter__(self):
+        # Python 3 only, `async for obj in queryset`
+        from .aio import aiterate
+        return aiterate(self)
+
+    def __getitem__(self, k):
+        if self._result_cache is not None:
+            return self._result_cache[k]
+        # Slicing is lazy like django `QuerySet`, the limits are
+        # pushed down to the Disqus API when the clone is evaluated.
+        if isinstance(k, slice):
+            assert ((k.start is None or k.start >= 0) and
+                    (k.stop is None or k.stop >= 0)), \
+                "Negative indexing is not supported."
+            clone = self._clone()
+            clone._set_limits(k.start, k.stop)
+            return list(clone)[::k.step] if k.step else clone
+        assert k >= 0, "Negative indexing is not supported."
+        clone = self._clone()
+        clone._set_limits(k, k + 1)
+        return list(clone)[0]
 
     def __len__(self):
         if self._result_cache is None:
@@ -125,22 +362,238 @@ class DisqusQuerySet(object):
 
     def _clone(self, **kwargs):
         clone = self.__class__(model=self.model, query=self.query, using=self.using)
-        clone.query_objs = self.query_objs
+        clone.query_objs = list(self.query_objs)
+        clone._low_mark = self._low_mark
+        clone._high_mark = self._high_mark
+        clone._ordering = list(self._ordering)
+        clone._fields = self._fields
+        clone._values_as = self._values_as
+        clone._deferred_loading = self._deferred_loading
         return clone
 
+    def _set_limits(self, low=None, high=None):
+        # Same as `django.db.models.sql.Query.set_limits`,
+        # the new limits are relative to the current ones.
+        if high is not None:
+            if self._high_mark is not None:
+                self._high_mark = min(self._high_mark, self._low_mark + high)
+            else:
+                self._high_mark = self._low_mark + high
+        if low is not None:
+            if self._high_mark is not None:
+                self._low_mark = min(self._high_mark, self._low_mark + low)
+            else:
+                self._low_mark = self._low_mark + low
+
     # Iterator factory
     def iterator(self):
         return iter(self._iterable_class(self))
 
+    def get_row_fields(self):
+        if self._row_fields is None:
+            self.__class__._row_fields = get_row_fields(self.model, self.row_keys)
+        return self._row_fields
+
+    def compile_filters(self, query_objs=None):
+        if query_objs is None:
+            query_objs = self.query_objs
+        return compile_filters(query_objs, self.get_row_fields())
+
+    # Query planner
+
+    def plan(self):
+        """
+        Map the lookups onto Disqus API parameters before any request
+        is sent. A lookup is removed from the local filters only when
+        the API answers it exactly; range lookups just narrow the listing
+        and are still checked locally.
+        """
+        plan = QueryPlan()
+        row_fields = self.get_row_fields()
+        for q in self.query_objs:
+            if isinstance(q, Query) and not q.negate:
+                row_field, lookup_name = split_lookup(q.query_string, row_fields)
+                if self.push_down(plan, q, row_field.model_field.name, lookup_name,
+                                  row_field.prepare):
+                    continue
+            plan.query_objs.append(q)
+        if plan.pks is not None and (len(self.query_objs) > 1 or not is_pk_ordering(self._ordering)):
+            # The details API only answers a page of ids sorted by
+            # themselves, otherwise the listing is filtered locally
+            plan.query_objs.append(plan.pks_query)
+            plan.pks = plan.pks_query = None
+        plan.ordering = self.plan_ordering(plan)
+        return plan
+
+    def plan_ordering(self, plan):
+        """
+        Disqus sorts listings by date natively with the `order` parameter,
+        return the ordering which is left to be sorted locally.
+        The ids of Disqus grow with time, so ordering by primary key,
+        which is what admin changelist uses by default, is native too.
+        """
+        ordering = [o for o in self._ordering if o != '?']
+        if not ordering or plan.pk is not None or plan.pks is not None:
+            return []
+        if ordering[0].lstrip('-') in ('created_at', 'id', 'pk'):
+            plan.params['order'] = 'desc' if ordering[0].startswith('-') else 'asc'
+            if all(o.lstrip('-') in ('id', 'pk') for o in ordering[1:]):
+                return []
+        return ordering
+
+    def push_down(self, plan, q, field_name, lookup_name, prepare):
+        """
+        Put the lookup into `plan`, return True if it's answered exactly.
+        """
+        if field_name == 'id' and lookup_name == 'exact' and plan.pk is None:
+            plan.pk = prepare(q.value)
+            plan.pk_query = q
+            return True
+        if field_name == 'forum' and lookup_name == 'exact' and 'forum' not in plan.params:
+            plan.params['forum'] = q.value
+            return True
+        if field_name == 'created_at' and q.value is not None:
+            if lookup_name in ('gt', 'gte'):
+                plan.params['start'] = to_disqus_datetime(prepare(q.value))
+            elif lookup_name in ('lt', 'lte'):
+                plan.params['end'] = to_disqus_datetime(prepare(q.value))
+        return False
+
     # Create Model Instance
     def create(self, *args, **kwargs):
         obj = self.model(**kwargs)
         return obj
 
+    def get_attnames(self):
+        if self._attnames is None:
+            self.__class__._attnames = [f.attname for f in self.model._meta.concrete_fields]
+        return self._attnames
+
+    def get_loaded_attnames(self):
+        """
+        The attnames loaded by `only()`/`defer()`, the primary key is
+        always loaded.
+        """
+        names, defer = self._deferred_loading
+        if defer and not names:
+            return self.get_attnames()
+        return [
+            f.attname for f in self.model._meta.concrete_fields
+            if f.primary_key or ((f.name in names or f.attname in names) != defer)
+        ]
+
+    def get_deferred_model(self, attnames):
+        key = (self.model, tuple(attnames))
+        if key not in deferred_models:
+            deferred_models[key] = deferred_class_factory(self.model, [
+                attname for attname in self.get_attnames() if attname not in attnames
+            ])
+        return deferred_models[key]
+
+    def from_values(self, values, attnames=None):
+        """
+        Build an instance loaded from Disqus and take its snapshot, `values`
+        are in the order of the concrete fields like `Model.from_db`, or of
+        `attnames` if only these fields are loaded.
+        Unless someone listens to `pre_init`/`post_init`, `Model.__init__`
+        is skipped and the values are put into the instance `__dict__`.
+        """
+        model = self.model
+        if attnames is None:
+            attnames = self.get_attnames()
+        elif deferred_class_factory is not None and len(attnames) < len(self.get_attnames()):
+            model = self.get_deferred_model(attnames)
+        if signals.pre_init.has_listeners(model) or signals.post_init.has_listeners(model):
+            obj = model.from_db(None, attnames, values)
+        else:
+            obj = model.__new__(model)
+            obj.__dict__.update(zip(attnames, values))
+            obj._state = ModelState()
+            # Not a new instance, for the unique check in admin changeform view
+            obj._state.adding = False
+        obj._disqus_snapshot = dict(zip(attnames, values))
+        return obj
+
+    def take_snapshot(self, obj):
+        """
+        Remember the field values of an instance loaded from Disqus,
+        `update` sends only the fields changed since then.
+        """
+        obj._disqus_snapshot = dict(
+            (f.attname, getattr(obj, f.attname)) for f in obj._meta.concrete_fields
+            if f.attname in obj.__dict__
+        )
+
+    def check_remote(self, pk, snapshot, changed):
+        """
+        Raise `ConcurrentModificationError` if any of the `changed`
+        attnames was modified on Disqus after `snapshot` was taken.
+        """
+        # The cached row may be the one the snapshot was taken from
+        rows = self._iterable_class(self).fetch_remote_detail(pk)
+        if not rows:
+            raise ConcurrentModificationError(
+                "{model} {pk} doesn't exist anymore.".format(model=self.model.__name__, pk=pk))
+        row_fields = self.get_row_fields()
+        for attname in changed:
+            row_field = row_fields.get(attname)
+            if row_field is not None and row_field.get_value(rows[0]) != snapshot[attname]:
+                raise ConcurrentModificationError(
+                    "{model} {pk} has been changed on Disqus.".format(model=self.model.__name__, pk=pk))
+
+    def update(self, new_instance):
+        snapshot = getattr(new_instance, '_disqus_snapshot', None)
+        # The fields which are still deferred aren't changed
+        loaded = [attname for attname in self.get_attnames() if attname in new_instance.__dict__]
+        if snapshot is None or any(attname not in snapshot for attname in loaded):
+            # Not loaded by a queryset, ex. created by hand,
+            # or a deferred field has been loaded since then
+            remote = self.get(id=new_instance.id)
+            if remote is None:
+                raise self.model.DoesNotExist(
+                    "{model} {pk} doesn't exist on Disqus.".format(model=self.model.__name__, pk=new_instance.id))
+            snapshot = dict(remote._disqus_snapshot, **(snapshot or {}))
+        changed = [attname for attname in loaded if getattr(new_instance, attname) != snapshot[attname]]
+        if changed and getattr(settings, 'DISQUS_OPTIMISTIC_CONCURRENCY', False):
+            self.check_remote(new_instance.pk, snapshot, changed)
+        for attname in sorted(changed):
+            update_func = getattr(self.query, 'change_{entity}_{attname}'.format(
+                entity=self._iterable_class.entity, attname=attname))
+            update_func(new_instance.id, snapshot[attname], getattr(new_instance, attname))
+        self.take_snapshot(new_instance)
+
     # Public Method which sends request
 
     def count(self, *args, **kwargs):
-        return len(self)
+        """
+        Count the rows without building model instances. The count is
+        cached in `count_cache` by the API parameters and the local
+        filters, the admin asks for it on every changelist render.
+        """
+        if self._result_cache is not None:
+            return len(self._result_cache)
+        if read_from_mirror():
+            return get_mirror_queryset(self).count()
+        iterable = self._iterable_class(self)
+        method_name, kwargs, query_objs, ordering = iterable.source()
+        if method_name == 'fetch_details':
+            # The page of ids is counted without a request, the ids
+            # removed on Disqus are dropped when the page is fetched
+            return len(kwargs['pks'])
+        # The order doesn't change the number of rows
+        key = count_cache.make_key(iterable.entity, dict(
+            kwargs, method_name=method_name,
+            filters=None if query_objs is None else [describe_query_obj(q) for q in query_objs],
+            low_mark=self._low_mark, high_mark=self._high_mark,
+        ))
+        count = count_cache.get(key)
+        if count is None:
+            # The pages walked for counting aren't kept in the query cache
+            with saving_skipped():
+                rows = iterable.rows((method_name, kwargs, query_objs, []))
+                count = sum(1 for row in rows)
+            count_cache.set(key, count)
+        return count
 
     def get(self, *args, **kwargs):
         clone = self.filter(*args, **kwargs)
@@ -155,16 +608,48 @@ class DisqusQuerySet(object):
                 (self.model._meta.object_name, len(self._result_cache))
             )
 
+    def selected_ids(self):
+        """
+        Return the primary keys of the queryset. A queryset only filtered
+        by `pk__in`, like the querysets of admin actions, isn't fetched.
+        """
+        if (self._result_cache is None and len(self.query_objs) == 1 and
+                self._low_mark == 0 and self._high_mark is None):
+            q = self.query_objs[0]
+            if isinstance(q, Query) and not q.negate:
+                row_field, lookup_name = split_lookup(q.query_string, self.get_row_fields())
+                if row_field.model_field.primary_key and lookup_name == 'in':
+                    return sorted(set(row_field.prepare(v) for v in q.value))
+        return [obj.pk for obj in self]
+
+    def run_in_chunks(self, method):
+        """
+        Call the multi-id write `method` with the selected ids in chunks,
+        return the number of succeeded ids and a dict of failed ids.
+        """
+        ids = self.selected_ids()
+        failures = self.query.run_in_chunks(method, ids)
+        return len(ids) - len(failures), failures
+
+    def in_bulk(self, id_list=None):
+        objs = self if id_list is None else self.filter(pk__in=id_list)
+        return dict((obj.pk, obj) for obj in objs)
+
     def exists(self):
-        if self._result_cache is None:
-            try:
-                self.iterator().next()
-            except StopIteration as e:
-                return False
+        if self._result_cache is not None:
+            return bool(self._result_cache)
+        if read_from_mirror():
+            return get_mirror_queryset(self).exists()
+        # Only the first row is asked for, `limit=1` when it's pushed down
+        clone = self._clone()
+        clone._set_limits(0, 1)
+        iterable = clone._iterable_class(clone)
+        method_name, kwargs, query_objs, ordering = iterable.source()
+        for row in iterable.rows((method_name, kwargs, query_objs, [])):
             return True
-        return bool(self._result_cache)
+        return False
 
-    # Public method to add query, currently only support primary key
+    # Public method to add query
 
     def filter(self, *args, **kwargs):
         return self.filter_or_exclude(False, *args, **kwargs)
@@ -173,12 +658,79 @@ class DisqusQuerySet(object):
         return self.filter_or_exclude(True, *args, **kwargs)
 
     def filter_or_exclude(self, negate, *args, **kwargs):
+        assert self._low_mark == 0 and self._high_mark is None, \
+            "Cannot filter a query once a slice has been taken."
         clone = self._clone()
+        if negate:
+            if args or kwargs:
+                clone.query_objs.append(~Q(*args, **kwargs))
+            return clone
+        clone.query_objs.extend(args)
         for k, v in kwargs.items():
             q = Query(k, v, negate=negate)
             clone.query_objs.append(q)
         return clone
 
+    def complex_filter(self, filter_obj):
+        if isinstance(filter_obj, Q):
+            return self.filter(filter_obj)
+        return self.filter(**filter_obj)
+
+    def order_by(self, *field_names):
+        assert self._low_mark == 0 and self._high_mark is None, \
+            "Cannot reorder a query once a slice has been taken."
+        clone = self._clone()
+        clone._ordering = list(field_names)
+        return clone
+
+    @property
+    def ordered(self):
+        return bool(self._ordering)
+
+    # Partial results, the rows are converted without building instances
+
+    def values(self, *fields):
+        return self._values(fields, 'dict')
+
+    def values_list(self, *fields, **kwargs):
+        flat = kwargs.pop('flat', False)
+        if kwargs:
+            raise TypeError('Unexpected keyword arguments to values_list: %s' % (list(kwargs),))
+        if flat and len(fields) > 1:
+            raise TypeError("'flat' is not valid when values_list is called with more than one field.")
+        return self._values(fields, 'flat' if flat else 'tuple')
+
+    def _values(self, fields, values_as):
+        fields = fields or tuple(self.get_attnames())
+        row_fields = self.get_row_fields()
+        for name in fields:
+            if name not in row_fields:
+                raise FieldError("Cannot resolve keyword '%s' into field. Choices are: %s" % (
+                    name, ', '.join(sorted(row_fields))))
+        clone = self._clone()
+        clone._fields = tuple(fields)
+        clone._values_as = values_as
+        return clone
+
+    def defer(self, *fields):
+        clone = self._clone()
+        if fields == (None,):
+            clone._deferred_loading = (frozenset(), True)
+            return clone
+        names, defer = self._deferred_loading
+        if defer:
+            clone._deferred_loading = (names.union(fields), True)
+        else:
+            clone._deferred_loading = (names.difference(fields), False)
+        return clone
+
+    def only(self, *fields):
+        if fields == (None,):
+            raise TypeError("Cannot pass None as an argument to only().")
+        clone = self._clone()
+        clone._deferred_loading = (frozenset(fields), False)
+        return clone
+
     # Dumb Implementation
 
     def using(self, alias):
@@ -186,12 +738,6 @@ class DisqusQuerySet(object):
         clone._db = alias
         return clone
 
-    def order_by(self, *args, **kwargs):
-        return self._clone()
-
-    def complex_filter(self, filter_obj):
-        return self._clone()
-
     def all(self, *args, **kwargs):
         return self._clone()
 
@@ -200,48 +746,119 @@ class DisqusQuerySet(object):
 
 
 class ThreadQuerySet(DisqusQuerySet):
+    row_keys = {
+        'id': 'id',
+        'forum': 'forum',
+        'is_closed': 'isClosed',
+        'link': 'link',
+        'title': 'title',
+        'created_at': 'createdAt',
+    }
+    _row_fields = None
+    _attnames = None
+
     def __init__(self, model=None, query=None, using=None, hints=None):
         super(ThreadQuerySet, self).__init__(model, query, using, hints)
         self._iterable_class = ThreadIterable
 
-    def delete(self, obj):
-        # Have to remove posts at first
-        posts_list = self.query.get_posts_list(thread_id=obj.id)['response']
-        post_ids = [post['id'] for post in posts_list]
-        self.query.delete_posts(post_ids)
+    def push_down(self, plan, q, field_name, lookup_name, prepare):
+        if field_name == 'id' and lookup_name == 'in' and 'thread_ids' not in plan.params:
+            # `threads/list` with repeated `thread` parameters
+            plan.params['thread_ids'] = sorted(set(prepare(v) for v in q.value))
+            return True
+        return super(ThreadQuerySet, self).push_down(plan, q, field_name, lookup_name, prepare)
+
+    def delete(self, obj=None):
+        thread_ids = [obj.id] if obj is not None else self.selected_ids()
+        return self.delete_threads(thread_ids)
+
+    def delete_threads(self, thread_ids):
+        """
+        Remove the threads with all of their posts. Every page of posts
+        is deleted in the background while the next page is downloading,
+        then the threads are removed in batches. A thread is kept if any
+        of its posts can't be deleted. The caches are invalidated once
+        at the end.
+        Return the number of deleted threads and a dict of failed ids.
+        """
+        query = self.query
+        failures = {}
+        # The pool workers send the deletes with the priority of this thread
+        priority = current_priority(WRITE)
+        pool = ThreadPool(query.client.pool_size)
+        try:
+            with cache_registry.deferred():
+                pending = []
+                for thread_id in thread_ids:
+                    # Have to remove posts at first
+                    for page in query.iter_pages(query.get_posts_list, thread_id=thread_id):
+                        post_ids = [post['id'] for post in page['response']]
+                        if post_ids:
+                            result = pool.apply_async(cache_registry.bind(query.run_in_chunks),
+                                                      (query.delete_posts, post_ids, None, priority))
+                            pending.append((thread_id, result))
+                for thread_id, result in pending:
+                    post_failures = result.get()
+                    if post_failures and thread_id not in failures:
+                        failures[thread_id] = list(post_failures.values())[0]
+                deletable_ids = [thread_id for thread_id in thread_ids if thread_id not in failures]
+                thread_failures = query.run_in_chunks(query.delete_threads, deletable_ids)
+        finally:
+            pool.close()
+            pool.join()
+        failures.update(thread_failures)
+        return len(deletable_ids) - len(thread_failures), failures
 
-        self.query.delete_thread(obj.id)
-
-    def update(self, new_instance):
-        old_instance = self.get(id=new_instance.id)
-        fields = self.model._meta.get_fields()
-        for f in fields:
-            attname = getattr(f, 'attname', None)
-            if attname:
-                old_val = getattr(old_instance, f.attname)
-                new_val = getattr(new_instance, f.attname)
-                if old_val != new_val:
-                    update_func = getattr(self.query, 'change_thread_'+attname)
-                    update_func(new_instance.id, old_val, new_val)
 
 
 class PostQuerySet(DisqusQuerySet):
+    row_keys = {
+        'id': 'id',
+        'forum': 'forum',
+        'is_approved': 'isApproved',
+        'message': 'raw_message',
+        'thread': 'thread',
+        'created_at': 'createdAt',
+    }
+    _row_fields = None
+    _attnames = None
+
     def __init__(self, model=None, query=None, using=None, hints=None):
         super(PostQuerySet, self).__init__(model, query, using, hints)
         self._iterable_class = PostIterable
 
-    def delete(self, obj):
-        # Have to remove posts at first
-        self.query.delete_post(obj.id)
+    def push_down(self, plan, q, field_name, lookup_name, prepare):
+        if field_name == 'thread' and 'thread_id' not in plan.params:
+            if lookup_name == 'exact' and q.value is not None:
+                plan.params['thread_id'] = prepare(q.value)
+                return True
+            if lookup_name == 'in' and len(set(prepare(v) for v in q.value)) == 1:
+                plan.params['thread_id'] = prepare(list(q.value)[0])
+                return True
+        if field_name == 'id' and lookup_name == 'in' and plan.pks is None:
+            # There's no listing of posts by id, use the details API
+            plan.pks = sorted(set(prepare(v) for v in q.value))
+            plan.pks_query = q
+            return True
+        if field_name == 'is_approved' and lookup_name == 'exact' and 'include' not in plan.params:
+            if prepare(q.value):
+                plan.params['include'] = ['approved', 'flagged', 'highlighted']
+            else:
+                plan.params['include'] = ['unapproved', 'spam']
+        return super(PostQuerySet, self).push_down(plan, q, field_name, lookup_name, prepare)
+
+    def delete(self, obj=None):
+        if obj is not None:
+            return self.query.delete_post(obj.id)
+        # Delete the whole queryset in batches
+        return self.run_in_chunks(self.query.delete_posts)
+
+    def approve(self):
+        return self.run_in_chunks(self.query.approve_posts)
+
+    def spam(self):
+        return self.run_in_chunks(self.query.spam_posts)
+
+    def restore(self):
+        return self.run_in_chunks(self.query.restore_posts)
 
-    def update(self, new_instance):
-        old_instance = self.get(id=new_instance.id)
-        fields = self.model._meta.get_fields()
-        for f in fields:
-            attname = getattr(f, 'attname', None)
-            if attname:
-                old_val = getattr(old_instance, f.attname)
-                new_val = getattr(new_instance, f.attname)
-                if old_val != new_val:
-                    update_func = getattr(self.query, 'change_post_'+attname)
-                    update_func(new_instance.id, old_val, new_val)
@@ -0,0 +1,181 @@
+"""
+Scheduling of the requests sent to Disqus.
+
+Disqus allows a limited number of requests per hour, the remaining
+number and the reset time are returned in the `X-Ratelimit-Remaining`
+and `X-Ratelimit-Reset` headers. `RequestScheduler` keeps that budget,
+gives free connections to the most important requests first and
+computes the backoff of retried requests.
+"""
+import contextlib
+import heapq
+import itertools
+import random
+import threading
+import time
+
+from django.conf import settings
+
+# Priority classes, the smaller goes first
+WRITE = 0
+READ = 1
+BACKGROUND = 2
+
+_local = threading.local()
+
+
+@contextlib.contextmanager
+def request_priority(priority):
+    """
+    Send the requests made in the block with `priority`,
+    ex. the cache refreshing thread sends its reads as `BACKGROUND`.
+    """
+    previous = getattr(_local, 'priority', None)
+    _local.priority = priority
+    try:
+        yield
+    finally:
+        _local.priority = previous
+
+
+def current_priority(default):
+    priority = getattr(_local, 'priority', None)
+    return default if priority is None else priority
+
+
+class RequestScheduler(object):
+    """
+    A token bucket filled by the rate-limit headers of Disqus responses,
+    plus a priority queue for the connection slots.
+
+    `reserve` tokens of the hourly budget are kept for writes, and
+    background reads stop at twice of it. A request which would wait for
+    the budget longer than `max_wait` seconds is rejected instead,
+    so the callers can fall back to cached results.
+    """
+    def __init__(self, concurrency=None, reserve=None, max_wait=None,
+                 max_retries=None, backoff_seconds=None, max_backoff_seconds=30):
+        self.concurrency = concurrency or getattr(settings, "DISQUS_HTTP_POOL_SIZE", 10)
+        self.reserve = reserve if reserve is not None else \
+            getattr(settings, "DISQUS_RATE_LIMIT_RESERVE", 50)
+        self.max_wait = max_wait if max_wait is not None else \
+            getattr(settings, "DISQUS_RATE_LIMIT_MAX_WAIT", 5)
+        self.max_retries = max_retries if max_retries is not None else \
+            getattr(settings, "DISQUS_HTTP_MAX_RETRIES", 3)
+        self.backoff_seconds = backoff_seconds if backoff_seconds is not None else \
+            getattr(settings, "DISQUS_HTTP_BACKOFF_SECONDS", 0.5)
+        self.max_backoff_seconds = max_backoff_seconds
+        self.condition = threading.Condition()
+        self.counter = itertools.count()
+        self.waiting = []
+        self.active = 0
+        # Unknown until the first response
+        self.remaining = None
+        self.reset_at = None
+        self.stats = {
+            'requests': 0,
+            'retries': 0,
+            'rejected': 0,
+            'queued_seconds': 0.0,
+            'throttled_seconds': 0.0,
+            'backoff_seconds': 0.0,
+        }
+
+    def budget(self, priority, now):
+        """Return how many requests of `priority` can be sent now"""
+        if self.remaining is None:
+            return 1
+        if self.reset_at is not None and now >= self.reset_at:
+            # A new rate-limit window, wait for the next headers
+            self.remaining = None
+            self.reset_at = None
+            return 1
+        return self.remaining - self.reserve * priority
+
+    def acquire(self, priority=READ):
+        """
+        Block until a slot and a token are given to the request,
+        requests are served in priority order. Return False if the
+        request is rejected by the rate limit, otherwise `release`
+        has to be called once the request is done.
+        """
+        ticket = (priority, next(self.counter))
+        start = time.time()
+        throttled = 0.0
+        with self.condition:
+            heapq.heappush(self.waiting, ticket)
+            try:
+                while True:
+                    now = time.time()
+                    if self.waiting[0] != ticket or self.active >= self.concurrency:
+                        self.condition.wait(1)
+                        continue
+                    if self.budget(priority, now) > 0:
+                        break
+                    if self.reset_at is not None:
+                        wait_seconds = self.reset_at - now
+                    else:
+                        # Until another response tells the budget
+                        wait_seconds = self.backoff_seconds or 0.1
+                    if now - start + wait_seconds > self.max_wait:
+                        self.stats['rejected'] += 1
+                        return False
+                    self.condition.wait(wait_seconds)
+                    throttled += time.time() - now
+            finally:
+                self.waiting.remove(ticket)
+                heapq.heapify(self.waiting)
+                self.condition.notify_all()
+            self.active += 1
+            if self.remaining is not None:
+                self.remaining -= 1
+            self.stats['requests'] += 1
+            self.stats['throttled_seconds'] += throttled
+            self.stats['queued_seconds'] += time.time() - start - throttled
+            return True
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    def update(self, headers):
+        remaining = headers.get('X-Ratelimit-Remaining')
+        reset_at = headers.get('X-Ratelimit-Reset')
+        try:
+            with self.condition:
+                if remaining is not None:
+                    self.remaining = int(remaining)
+                if reset_at is not None:
+                    self.reset_at = float(reset_at)
+        except ValueError:
+            pass
+
+    def exhaust(self, reset_at=None):
+        """The quota is used up, ex. Disqus answered a rate limit error"""
+        with self.condition:
+            self.remaining = 0
+            if reset_at is not None:
+                self.reset_at = reset_at
+            elif self.reset_at is None:
+                # Disqus counts the quota per clock hour
+                self.reset_at = (int(time.time()) // 3600 + 1) * 3600
+
+    def backoff(self, attempt):
+        """
+        Sleep before the retry `attempt` (starts from 0),
+        exponential backoff with full jitter.
+        """
+        delay = random.uniform(0, min(self.max_backoff_seconds,
+                                      self.backoff_seconds * 2 ** attempt))
+        with self.condition:
+            self.stats['retries'] += 1
+            self.stats['backoff_seconds'] += delay
+        time.sleep(delay)
+
+    def get_stats(self):
+        with self.condition:
+            stats = dict(self.stats)
+            stats['remaining'] = self.remaining
+            stats['reset_at'] = self.reset_at
+            return stats
@@ -0,0 +1,171 @@
+"""
+A local full-text index of the Disqus threads and posts for admin search.
+
+The index is an SQLite FTS5 (or FTS4) database at
+`DISQUS_SEARCH_INDEX_PATH`. The rows of every listing fetched by the
+querysets are indexed, and the known changes of write operations are
+applied like a query cache, so searching never scans the forum.
+"""
+import itertools
+import re
+import sqlite3
+import threading
+
+from django.conf import settings
+
+from .utils import Change, cache_registry
+
+# entity -> (table name, indexed columns)
+TABLES = {
+    'thread': ('threads', ['title']),
+    'post': ('posts', ['message', 'author']),
+}
+
+
+def get_row_values(entity, row):
+    if entity == 'thread':
+        return [row.get('title') or '']
+    author = row.get('author') or {}
+    if not isinstance(author, dict):
+        author = {}
+    return [
+        row.get('raw_message') or '',
+        ' '.join(filter(None, [author.get('name'), author.get('username')])),
+    ]
+
+
+def to_match_query(term):
+    """
+    Every word of `term` has to match as a prefix, quotes are escaped
+    so the user can't write FTS query syntax.
+    """
+    words = re.findall(r'\w+', term, re.UNICODE)
+    return ' '.join('"%s"*' % word for word in words)
+
+
+class SearchIndex(object):
+    # The number of ids bound to one statement, SQLite limits the
+    # bound variables to 999 by default
+    batch_size = 500
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.path = None
+        self.connection = None
+
+    @property
+    def enabled(self):
+        return getattr(settings, 'DISQUS_SEARCH_INDEX_PATH', None) is not None
+
+    def connect(self):
+        path = settings.DISQUS_SEARCH_INDEX_PATH
+        if self.connection is None or self.path != path:
+            connection = sqlite3.connect(path, check_same_thread=False)
+            try:
+                self.create_tables(connection, 'fts5')
+            except sqlite3.OperationalError:
+                self.create_tables(connection, 'fts4')
+            self.connection = connection
+            self.path = path
+        return self.connection
+
+    def create_tables(self, connection, module):
+        for table, columns in TABLES.values():
+            connection.execute('CREATE VIRTUAL TABLE IF NOT EXISTS {table} USING {module}({columns})'.format(
+                table=table, module=module, columns=', '.join(columns)))
+        # The thread of each post, a plain table to look up by thread
+        connection.execute('CREATE TABLE IF NOT EXISTS post_threads'
+                           ' (post_id INTEGER PRIMARY KEY, thread_id INTEGER)')
+        connection.execute('CREATE INDEX IF NOT EXISTS post_threads_thread_id ON post_threads (thread_id)')
+
+    def add(self, entity, rows):
+        table, columns = TABLES[entity]
+        rows = list(rows)
+        values = [[int(row['id'])] + get_row_values(entity, row) for row in rows]
+        sql = 'INSERT OR REPLACE INTO {table}(rowid, {columns}) VALUES (?, {marks})'.format(
+            table=table, columns=', '.join(columns), marks=', '.join('?' * len(columns)))
+        with self.lock:
+            connection = self.connect()
+            with connection:
+                connection.executemany(sql, values)
+                if entity == 'post':
+                    connection.executemany(
+                        'INSERT OR REPLACE INTO post_threads(post_id, thread_id) VALUES (?, ?)',
+                        [(int(row['id']), int(row['thread'])) for row in rows if row.get('thread')])
+
+    def observe(self, entity, rows, batch_size=100):
+        """
+        Index the rows passing through a listing fetch, a batch at a time.
+        """
+        if not self.enabled:
+            return rows
+        return self._observe(entity, iter(rows), batch_size)
+
+    def _observe(self, entity, rows, batch_size):
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                return
+            self.add(entity, batch)
+            for row in batch:
+                yield row
+
+    def search(self, entity, term):
+        """
+        Return the ids matching every word of `term`. The posts of
+        the threads whose title matches are included.
+        """
+        match = to_match_query(term)
+        if not match:
+            return []
+        table = TABLES[entity][0]
+        sql = 'SELECT rowid FROM {table} WHERE {table} MATCH ?'.format(table=table)
+        params = [match]
+        if entity == 'post':
+            sql += (' UNION SELECT post_id FROM post_threads WHERE thread_id IN'
+                    ' (SELECT rowid FROM threads WHERE threads MATCH ?)')
+            params.append(match)
+        with self.lock:
+            return [row[0] for row in self.connect().execute(sql, params)]
+
+    def discard(self, entity, ids):
+        """Remove the rows which don't exist on Disqus anymore"""
+        self.patch(Change(entity, ids, removed=True))
+
+    def clear(self):
+        # The change is unknown, the rows are indexed again when listed
+        pass
+
+    def patch(self, change):
+        if not self.enabled:
+            return
+        table = TABLES[change.entity][0]
+        ids = [int(entity_id) for entity_id in change.ids]
+        with self.lock:
+            connection = self.connect()
+            with connection:
+                if change.removed:
+                    for i in range(0, len(ids), self.batch_size):
+                        self.delete(connection, table, change.entity, ids[i:i + self.batch_size])
+                elif change.entity == 'post' and 'raw_message' in change.fields:
+                    connection.executemany('UPDATE posts SET message = ? WHERE rowid = ?',
+                                           [(change.fields['raw_message'], i) for i in ids])
+
+    def delete(self, connection, table, entity, ids):
+        marks = ', '.join('?' * len(ids))
+        connection.execute('DELETE FROM {table} WHERE rowid IN ({marks})'.format(
+            table=table, marks=marks), ids)
+        if entity == 'thread':
+            connection.execute(
+                'DELETE FROM posts WHERE rowid IN'
+                ' (SELECT post_id FROM post_threads WHERE thread_id IN ({marks}))'.format(marks=marks), ids)
+            connection.execute(
+                'DELETE FROM post_threads WHERE thread_id IN ({marks})'.format(marks=marks), ids)
+        else:
+            connection.execute(
+                'DELETE FROM post_threads WHERE post_id IN ({marks})'.format(marks=marks), ids)
+
+
+search_index = SearchIndex()
+cache_registry.register('thread', search_index)
+cache_registry.register('post', search_index)
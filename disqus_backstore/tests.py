@@ -1,24 +1,42 @@
 from __future__ import unicode_literals
 
+import datetime
 import json
 import os
+import threading
+import time
+import unittest
 
 import mock
+import requests
 
 from django.contrib import admin
 from django.contrib.admin.utils import quote
 from django.contrib.auth import get_permission_codename
 from django.contrib.auth.models import User, Permission
+from django.contrib.messages import get_messages
 from django.contrib.contenttypes.models import ContentType
-from django.test import TestCase, RequestFactory
+from django.core.management import call_command
+from django.db.models import Q
+from django.db.models.signals import post_init
+from django.test import TestCase, RequestFactory, override_settings
 from django.urls import reverse
+from django.utils import six, timezone
 from django.utils.html import format_html
 from django.utils.text import capfirst
 
 from .admin import ThreadAdmin, PostAdmin
-from .models import Thread, Post
-from disqus_interface import DisqusQuery, send_request_to_disqus, DISQUSAPIError
-from .utils import cache_clearer, query_cache
+from .models import Thread, Post, PostMirror, SyncState, ThreadMirror
+from .query import PostQuerySet, ThreadQuerySet, count_cache
+from .disqus_interface import (DisqusClient, DisqusQuery, send_request_to_disqus, DISQUSAPIError,
+                               RateLimitExceeded, RequestError, thread_cursor_cache)
+from .exceptions import ConcurrentModificationError
+from .mirror import get_mirror
+from .scheduler import BACKGROUND, RequestScheduler, current_priority, request_priority
+from .search import search_index
+from .sync import DeltaSync
+from .utils import (CacheRegistry, Change, LocalCacheStore, QueryRecord, SingleFlight, background_refresher,
+                    cache_clearer, cache_patcher, cache_registry, query_cache)
 
 
 TEST_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_data')
@@ -28,6 +46,47 @@ POST_DETAIL_RESPONSE = json.load(open(os.path.join(TEST_DATA_DIR, 'post_detail.j
 SINGLE_THREAD_LIST_RESPONSE = json.load(open(os.path.join(TEST_DATA_DIR, 'single_thread_list.json'), 'r'))
 
 
+def threads_list(thread_ids=None, *args, **kwargs):
+    """A fake `DisqusQuery.get_threads_list` which respects `thread_ids`"""
+    threads = THREADS_LIST_RESPONSE['response'] + SINGLE_THREAD_LIST_RESPONSE['response']
+    if thread_ids is None:
+        return THREADS_LIST_RESPONSE
+    thread_ids = [str(thread_id) for thread_id in thread_ids]
+    return dict(THREADS_LIST_RESPONSE, response=[t for t in threads if t['id'] in thread_ids])
+
+
+def posts_list(thread_id=None, *args, **kwargs):
+    """A fake `DisqusQuery.get_posts_list` which respects `thread_id`"""
+    if thread_id is None:
+        return POSTS_LIST_RESPONSE
+    return dict(POSTS_LIST_RESPONSE, response=[
+        p for p in POSTS_LIST_RESPONSE['response'] if p['thread'] == str(thread_id)
+    ])
+
+
+def thread_detail(thread_id, *args, **kwargs):
+    """A fake `DisqusQuery.get_thread`"""
+    for thread in THREADS_LIST_RESPONSE['response'] + SINGLE_THREAD_LIST_RESPONSE['response']:
+        if thread['id'] == str(thread_id):
+            return {'code': 0, 'response': thread}
+    raise DISQUSAPIError("Invalid argument, 'thread': Unable to find thread")
+
+
+def post_detail(post_id, *args, **kwargs):
+    """A fake `DisqusQuery.get_post`"""
+    for post in POSTS_LIST_RESPONSE['response']:
+        if post['id'] == str(post_id):
+            return {'code': 0, 'response': post}
+    raise DISQUSAPIError("Invalid argument, 'post': Unable to find post")
+
+
+def age_records(store, seconds):
+    """Make every record of a `ShardedCacheStore` older"""
+    for shard in store.shards:
+        for record in shard.records.values():
+            record.timestamp -= datetime.timedelta(seconds=seconds)
+
+
 def get_perm(Model, perm):
     """Return the permission object, for the Model"""
     ct = ContentType.objects.get_for_model(Model)
@@ -66,8 +125,14 @@ class MockSuperUser(object):
 
 
 class DisqusAdminTest(TestCase):
-
-    @mock.patch.object(DisqusQuery, 'get_threads_list', return_value=THREADS_LIST_RESPONSE)
+    def setUp(self):
+        # Admin views get the object by primary key, which uses the details API
+        for method_name, side_effect in [('get_thread', thread_detail), ('get_post', post_detail)]:
+            patcher = mock.patch.object(DisqusQuery, method_name, side_effect=side_effect)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    @mock.patch.object(DisqusQuery, 'get_threads_list', side_effect=threads_list)
     def test_thread_change_list_view__normal_case__correct_template_response(self, _):
         changelist_url = reverse(
             '{admin_site_name}:{app_label}_{model_name}_changelist'.format(
@@ -98,8 +163,8 @@ class DisqusAdminTest(TestCase):
         self.assertEqual(set(response.template_name), template_names)
         self.assertEqual(list(response.context_data['cl'].result_list), list(qs))
 
-    @mock.patch.object(DisqusQuery, 'get_threads_list', return_value=THREADS_LIST_RESPONSE)
-    @mock.patch.object(DisqusQuery, 'get_posts_list', return_value=POSTS_LIST_RESPONSE)
+    @mock.patch.object(DisqusQuery, 'get_threads_list', side_effect=threads_list)
+    @mock.patch.object(DisqusQuery, 'get_posts_list', side_effect=posts_list)
     def test_post_change_list_view__normal_case__correct_template_response(self, _, __):
         changelist_url = reverse(
             '{admin_site_name}:{app_label}_{model_name}_changelist'.format(
@@ -163,8 +228,8 @@ class DisqusAdminTest(TestCase):
             thread_object.id
         )
 
-    @mock.patch.object(DisqusQuery, 'get_threads_list', return_value=THREADS_LIST_RESPONSE)
-    @mock.patch.object(DisqusQuery, 'get_posts_list', return_value=POSTS_LIST_RESPONSE)
+    @mock.patch.object(DisqusQuery, 'get_threads_list', side_effect=threads_list)
+    @mock.patch.object(DisqusQuery, 'get_posts_list', side_effect=posts_list)
     def test_post_change_form_view__normal_case__correct_template_response(self, _, __):
         post_data = POST_DETAIL_RESPONSE['response']
         post_object = post_factory(post_data)
@@ -189,8 +254,8 @@ class DisqusAdminTest(TestCase):
             post_object.id
         )
 
-    @mock.patch.object(DisqusQuery, 'get_threads_list', return_value=THREADS_LIST_RESPONSE)
-    @mock.patch.object(DisqusQuery, 'get_posts_list', return_value=POSTS_LIST_RESPONSE)
+    @mock.patch.object(DisqusQuery, 'get_threads_list', side_effect=threads_list)
+    @mock.patch.object(DisqusQuery, 'get_posts_list', side_effect=posts_list)
     def test_thread_delete_view__get__success(self, _, __):
         thread_data = THREADS_LIST_RESPONSE['response'][0]
         post_data = POSTS_LIST_RESPONSE['response'][0]
@@ -227,11 +292,12 @@ class DisqusAdminTest(TestCase):
                                        ), None, (quote(obj._get_pk_val()),)),
                                        obj) for obj in [thread_object, related_post_object]]
         deleted_objects[1] = [deleted_objects[1]]
-        self.assertEqual(sorted(response.context_data['deleted_objects']),
-                         sorted(deleted_objects))
+        # A list and a string can't be compared on Python 3
+        self.assertEqual(sorted(response.context_data['deleted_objects'], key=repr),
+                         sorted(deleted_objects, key=repr))
 
-    @mock.patch.object(DisqusQuery, 'get_threads_list', return_value=THREADS_LIST_RESPONSE)
-    @mock.patch.object(DisqusQuery, 'get_posts_list', return_value=POSTS_LIST_RESPONSE)
+    @mock.patch.object(DisqusQuery, 'get_threads_list', side_effect=threads_list)
+    @mock.patch.object(DisqusQuery, 'get_posts_list', side_effect=posts_list)
     def test_thread_delete_action__post__success(self, _, __):
         thread_data = THREADS_LIST_RESPONSE['response'][0]
         post_data = POSTS_LIST_RESPONSE['response'][0]
@@ -314,11 +380,11 @@ class DisqusAdminTest(TestCase):
         self.assertEqual(sorted(response.context_data['deletable_objects']),
                          sorted(deleted_objects))
 
-    @mock.patch.object(DisqusQuery, 'delete_thread')
+    @mock.patch.object(DisqusQuery, 'delete_threads')
     @mock.patch.object(DisqusQuery, 'delete_posts')
-    @mock.patch.object(DisqusQuery, 'get_threads_list', return_value=THREADS_LIST_RESPONSE)
-    @mock.patch.object(DisqusQuery, 'get_posts_list', return_value=POSTS_LIST_RESPONSE)
-    def test_thread_delete_view__post__success(self, _, __, delete_posts_mock, delete_thread_mock):
+    @mock.patch.object(DisqusQuery, 'get_threads_list', side_effect=threads_list)
+    @mock.patch.object(DisqusQuery, 'get_posts_list', side_effect=posts_list)
+    def test_thread_delete_view__post__success(self, _, __, delete_posts_mock, delete_threads_mock):
         thread_data = THREADS_LIST_RESPONSE['response'][0]
         post_data = POSTS_LIST_RESPONSE['response'][0]
         thread_object = thread_factory(thread_data)
@@ -359,11 +425,11 @@ class DisqusAdminTest(TestCase):
         response = self.client.post(delete_url, delete_dict)
 
         self.assertEqual(response.status_code, 302)
-        delete_thread_mock.assert_called_once_with(thread_object.id)
+        delete_threads_mock.assert_called_once_with([thread_object.id])
         delete_posts_mock.assert_called_once()
 
-    @mock.patch.object(DisqusQuery, 'get_threads_list', return_value=THREADS_LIST_RESPONSE)
-    @mock.patch.object(DisqusQuery, 'get_posts_list', return_value=POSTS_LIST_RESPONSE)
+    @mock.patch.object(DisqusQuery, 'get_threads_list', side_effect=threads_list)
+    @mock.patch.object(DisqusQuery, 'get_posts_list', side_effect=posts_list)
     def test_post_delete_view__get__success(self, _, __):
         thread_data = THREADS_LIST_RESPONSE['response'][0]
         post_data = POSTS_LIST_RESPONSE['response'][0]
@@ -402,8 +468,8 @@ class DisqusAdminTest(TestCase):
                          deleted_objects)
 
     @mock.patch.object(DisqusQuery, 'delete_post')
-    @mock.patch.object(DisqusQuery, 'get_threads_list', return_value=THREADS_LIST_RESPONSE)
-    @mock.patch.object(DisqusQuery, 'get_posts_list', return_value=POSTS_LIST_RESPONSE)
+    @mock.patch.object(DisqusQuery, 'get_threads_list', side_effect=threads_list)
+    @mock.patch.object(DisqusQuery, 'get_posts_list', side_effect=posts_list)
     def test_post_delete_view__post__success(self, _, __, delete_post_mock):
         thread_data = THREADS_LIST_RESPONSE['response'][0]
         post_data = POSTS_LIST_RESPONSE['response'][0]
@@ -441,30 +507,800 @@ class DisqusAdminTest(TestCase):
         delete_post_mock.assert_called_once_with(post_object.id)
 
 
+    @mock.patch.object(DisqusQuery, 'spam_posts')
+    @mock.patch.object(DisqusQuery, 'get_posts_list', side_effect=posts_list)
+    def test_post_spam_action__post__one_batched_call(self, _, spam_posts_mock):
+        post_ids = [int(post['id']) for post in POSTS_LIST_RESPONSE['response']]
+        superuser = User.objects.create_superuser('superuser', 'superuser@example.com', 'secret')
+        self.client.force_login(superuser)
+        changelist_url = reverse('{admin_site_name}:{app_label}_{model_name}_changelist'.format(
+            admin_site_name=admin.site.name,
+            app_label=Post._meta.app_label,
+            model_name=Post._meta.model_name
+        ))
+        action_dict = {
+            'action': 'spam_posts',
+            'select_across': 0,
+            'index': 0,
+            '_selected_action': post_ids,
+        }
+
+        response = self.client.post(changelist_url, action_dict)
+
+        self.assertEqual(response.status_code, 302)
+        spam_posts_mock.assert_called_once_with(sorted(post_ids))
+        self.assertEqual([str(m) for m in get_messages(response.wsgi_request)],
+                         ["Successfully marked as spam %d posts." % len(post_ids)])
+
+
+    @mock.patch.object(DisqusQuery, 'get_posts_list', side_effect=posts_list)
+    def test_post_delete_in_batches_action__one_failure__report_it_without_fetching(self, _):
+        post_ids = [int(post['id']) for post in POSTS_LIST_RESPONSE['response']]
+
+        def delete_posts(ids):
+            if post_ids[0] in ids:
+                raise DISQUSAPIError("It can't be removed.")
+
+        superuser = User.objects.create_superuser('superuser', 'superuser@example.com', 'secret')
+        self.client.force_login(superuser)
+        changelist_url = reverse('{admin_site_name}:{app_label}_{model_name}_changelist'.format(
+            admin_site_name=admin.site.name,
+            app_label=Post._meta.app_label,
+            model_name=Post._meta.model_name
+        ))
+        action_dict = {
+            'action': 'delete_in_batches',
+            'select_across': 0,
+            'index': 0,
+            '_selected_action': post_ids,
+        }
+
+        with mock.patch.object(DisqusQuery, 'delete_posts', side_effect=delete_posts), \
+                mock.patch.object(DisqusQuery, 'get_post') as get_post_mock:
+            response = self.client.post(changelist_url, action_dict)
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(get_post_mock.call_count, 0)
+        self.assertEqual([str(m) for m in get_messages(response.wsgi_request)], [
+            "Successfully deleted %d posts." % (len(post_ids) - 1),
+            "Failed to handle posts %d: It can't be removed." % post_ids[0],
+        ])
+
+    @mock.patch.object(DisqusQuery, 'get_threads_list', side_effect=threads_list)
+    @mock.patch.object(DisqusQuery, 'get_posts_list', side_effect=posts_list)
+    def test_search_without_index__any_search_field__matched(self, _, __):
+        class ForumPostAdmin(PostAdmin):
+            search_fields = ['message', 'forum']
+
+        request = RequestFactory().get('/')
+        queryset, _ = ForumPostAdmin(Post, admin.site).get_search_results(
+            request, Post.objects.all(), 'loperuv')
+        self.assertEqual(len(list(queryset)), len(POSTS_LIST_RESPONSE['response']))
+        queryset, _ = PostAdmin(Post, admin.site).get_search_results(
+            request, Post.objects.all(), 'loperuv')
+        self.assertEqual(list(queryset), [])
+
+
 class DisqusThreadQuerySetTest(TestCase):
+    def setUp(self):
+        thread_cursor_cache.clear()
+        count_cache.clear()
+
+    def test_count__listing__no_instances_built_and_cached(self):
+        with mock.patch.object(DisqusQuery, 'get_threads_list',
+                               return_value=THREADS_LIST_RESPONSE) as list_mock, \
+                mock.patch.object(ThreadQuerySet, 'create') as create_mock:
+            self.assertEqual(Thread.objects.count(), len(THREADS_LIST_RESPONSE['response']))
+            self.assertEqual(Thread.objects.count(), len(THREADS_LIST_RESPONSE['response']))
+        self.assertEqual(create_mock.call_count, 0)
+        list_mock.assert_called_once_with(cursor=None, limit=100)
+
+    def test_count__listing_pages__not_saved_in_query_cache(self):
+        with mock.patch.object(DisqusClient, 'request', return_value=THREADS_LIST_RESPONSE) as request_mock:
+            self.assertEqual(Thread.objects.count(), len(THREADS_LIST_RESPONSE['response']))
+            self.assertEqual(len(list(Thread.objects.all())), len(THREADS_LIST_RESPONSE['response']))
+            self.assertEqual(len(list(Thread.objects.all())), len(THREADS_LIST_RESPONSE['response']))
+        # The page is only saved when it's listed
+        self.assertEqual(request_mock.call_count, 2)
+
+    def test_count__local_ordering__cached_like_native_ordering(self):
+        with mock.patch.object(DisqusQuery, 'get_threads_list',
+                               return_value=THREADS_LIST_RESPONSE) as list_mock:
+            for _ in range(2):
+                self.assertEqual(Thread.objects.order_by('title', '-pk').count(),
+                                 len(THREADS_LIST_RESPONSE['response']))
+                self.assertEqual(Thread.objects.filter(title__icontains='a').order_by('title').count(),
+                                 Thread.objects.filter(title__icontains='a').count())
+        self.assertEqual(list_mock.call_count, 2)
+
+    def test_seek__cursor_outdated_or_listing_cache_changed__start_from_first_page(self):
+        thread_cursor_cache.record({}, 100, 'cursor_100')
+        self.assertEqual(thread_cursor_cache.seek({}, 100), (100, 'cursor_100'))
+        with mock.patch('time.time', return_value=time.time() + 60):
+            self.assertEqual(thread_cursor_cache.seek({}, 100), (0, None))
+        thread_cursor_cache.record({}, 100, 'cursor_100')
+        DisqusQuery.__dict__['get_threads_list'].clear()
+        self.assertEqual(thread_cursor_cache.seek({}, 100), (0, None))
+
+    def test_exists__listing__ask_for_one_row(self):
+        with mock.patch.object(DisqusQuery, 'get_threads_list',
+                               return_value=THREADS_LIST_RESPONSE) as list_mock:
+            self.assertTrue(Thread.objects.exists())
+        list_mock.assert_called_once_with(cursor=None, limit=1)
+
+    def test_delete__many_pages_of_posts__purge_every_page_then_threads(self):
+        pages = {
+            None: {'response': [{'id': '1', 'thread': '7'}, {'id': '2', 'thread': '7'}],
+                   'cursor': {'hasNext': True, 'next': 'page2'}},
+            'page2': {'response': [{'id': '3', 'thread': '7'}],
+                      'cursor': {'hasNext': False}},
+        }
+        deleted_posts = []
+
+        def posts_list(thread_id=None, cursor=None, **kwargs):
+            return pages[cursor] if thread_id == 7 else {'response': [], 'cursor': {}}
+
+        with mock.patch.object(DisqusQuery, 'get_posts_list', side_effect=posts_list), \
+                mock.patch.object(DisqusQuery, 'delete_posts', side_effect=deleted_posts.extend), \
+                mock.patch.object(DisqusQuery, 'delete_threads') as delete_threads_mock:
+            count, failures = Thread.objects.filter(pk__in=[7, 8]).delete()
+        self.assertEqual((count, failures), (2, {}))
+        self.assertEqual(sorted(deleted_posts), ['1', '2', '3'])
+        delete_threads_mock.assert_called_once_with([7, 8])
+
     def test_get__normal_case__get_object_successfully(self):
         thread_data = THREADS_LIST_RESPONSE['response'][0]
         thread_id = int(thread_data.get('id'))
-        with mock.patch.object(DisqusQuery, 'get_threads_list', return_value={
-                'response': [thread_data]
-        }):
+        with mock.patch.object(DisqusQuery, 'get_thread', return_value={
+                'response': thread_data
+        }) as get_thread_mock:
             obj = Thread.objects.get(id=thread_id)
             self.assertEqual(obj.id, thread_id)
+        get_thread_mock.assert_called_once_with(thread_id)
+
+    def test_iterate__multiple_pages__follow_cursor(self):
+        threads_data = THREADS_LIST_RESPONSE['response']
+        first_page = {
+            'cursor': {'hasNext': True, 'next': 'next_cursor'},
+            'response': threads_data[:10],
+        }
+        last_page = {
+            'cursor': {'hasNext': False, 'next': None},
+            'response': threads_data[10:],
+        }
+        with mock.patch.object(DisqusQuery, 'get_threads_list',
+                               side_effect=[first_page, last_page]) as list_mock:
+            ids = [obj.id for obj in Thread.objects.all()]
+        self.assertEqual(ids, [int(thread['id']) for thread in threads_data])
+        self.assertEqual(list_mock.call_args_list[0][1]['cursor'], None)
+        self.assertEqual(list_mock.call_args_list[1][1]['cursor'], 'next_cursor')
+
+    def test_slice__no_filter__bounded_fetch(self):
+        with mock.patch.object(DisqusQuery, 'get_threads_list',
+                               return_value=THREADS_LIST_RESPONSE) as list_mock:
+            qs = Thread.objects.all()[:5]
+            self.assertEqual(list_mock.call_count, 0)
+            objs = list(qs)
+        self.assertEqual(len(objs), 5)
+        list_mock.assert_called_once_with(cursor=None, limit=5)
+
+    def test_slice__known_cursor__seek_without_replaying_pages(self):
+        threads_data = THREADS_LIST_RESPONSE['response']
+        first_page = {
+            'cursor': {'hasNext': True, 'next': 'next_cursor'},
+            'response': threads_data[:10],
+        }
+        last_page = {
+            'cursor': {'hasNext': False, 'next': None},
+            'response': threads_data[10:],
+        }
+        with mock.patch.object(DisqusQuery, 'get_threads_list',
+                               side_effect=[first_page, last_page]):
+            list(Thread.objects.all())
+        with mock.patch.object(DisqusQuery, 'get_threads_list',
+                               return_value=last_page) as list_mock:
+            objs = list(Thread.objects.all()[10:12])
+        list_mock.assert_called_once_with(cursor='next_cursor', limit=2)
+        self.assertEqual([obj.id for obj in objs],
+                         [int(thread['id']) for thread in threads_data[10:12]])
+
+
+class DisqusPostQuerySetTest(TestCase):
+    def test_access_thread__posts_page__resolve_referenced_threads_in_one_request(self):
+        posts_data = POSTS_LIST_RESPONSE['response']
+        with mock.patch.object(DisqusQuery, 'get_posts_list', return_value=POSTS_LIST_RESPONSE), \
+                mock.patch.object(DisqusQuery, 'get_threads_list',
+                                  return_value=THREADS_LIST_RESPONSE) as threads_mock:
+            posts = list(Post.objects.all())
+            self.assertEqual(threads_mock.call_count, 0)
+            thread_ids = [str(post.thread.id) for post in posts]
+        threads_mock.assert_called_once()
+        self.assertEqual(set(threads_mock.call_args[1]['thread_ids']),
+                         set(int(post['thread']) for post in posts_data))
+        self.assertEqual(thread_ids, [post['thread'] for post in posts_data])
+
+
+    @mock.patch.object(DisqusQuery, 'get_posts_list', side_effect=posts_list)
+    def test_iterate__post_init_receiver__fall_back_to_model_init(self, _):
+        posts_data = POSTS_LIST_RESPONSE['response']
+        fast_posts = list(Post.objects.all())
+        receiver = mock.Mock()
+        post_init.connect(receiver, sender=Post)
+        try:
+            posts = list(Post.objects.all())
+        finally:
+            post_init.disconnect(receiver, sender=Post)
+        self.assertEqual(receiver.call_count, len(posts_data))
+        for post, fast_post in zip(posts, fast_posts):
+            self.assertEqual(post._disqus_snapshot, fast_post._disqus_snapshot)
+            self.assertEqual(post.thread_id, fast_post.thread_id)
+            self.assertFalse(post._state.adding or fast_post._state.adding)
+
+    @mock.patch.object(DisqusQuery, 'get_posts_list', side_effect=posts_list)
+    def test_values__listing__rows_converted_without_instances(self, _):
+        posts_data = POSTS_LIST_RESPONSE['response']
+        with mock.patch.object(PostQuerySet, 'from_values') as from_values_mock, \
+                mock.patch.object(DisqusQuery, 'get_threads_list') as threads_list_mock:
+            ids = list(Post.objects.values_list('id', flat=True))
+            rows = list(Post.objects.filter(is_approved=True).values('id', 'thread'))
+            pairs = list(Post.objects.values_list('id', 'is_approved')[:2])
+        self.assertEqual(from_values_mock.call_count, 0)
+        self.assertEqual(threads_list_mock.call_count, 0)
+        self.assertEqual(ids, [int(p['id']) for p in posts_data])
+        self.assertEqual(rows, [{'id': int(p['id']), 'thread': int(p['thread'])}
+                                for p in posts_data if p['isApproved']])
+        self.assertEqual(pairs, [(int(p['id']), p['isApproved']) for p in posts_data[:2]])
+
+    @mock.patch.object(DisqusQuery, 'get_posts_list', side_effect=posts_list)
+    def test_only__deferred_field__loaded_by_details_on_access(self, _):
+        post_data = POSTS_LIST_RESPONSE['response'][0]
+        post = Post.objects.only('message')[0]
+        self.assertEqual((post.id, post.message), (int(post_data['id']), post_data['raw_message']))
+        with mock.patch.object(DisqusQuery, 'get_post', side_effect=post_detail) as get_post_mock:
+            self.assertEqual(post.is_approved, post_data['isApproved'])
+        get_post_mock.assert_called_once_with(int(post_data['id']))
+        self.assertEqual(Post.objects.defer('message', 'created_at')[0].__dict__.get('message'), None)
+
+    def test_bulk_delete__failed_chunk__retry_one_by_one_and_report_failures(self):
+        post_ids = list(range(1, 251))
+        calls = []
+
+        def delete_posts(ids):
+            calls.append(ids)
+            if 42 in ids:
+                raise DISQUSAPIError("Post 42 can't be removed.")
+
+        with mock.patch.object(DisqusQuery, 'delete_posts', side_effect=delete_posts), \
+                mock.patch.object(DisqusQuery, 'get_posts_list') as posts_list_mock:
+            count, failures = Post.objects.filter(pk__in=post_ids).delete()
+        self.assertEqual(posts_list_mock.call_count, 0)
+        self.assertEqual(count, 249)
+        self.assertEqual(list(failures), [42])
+        # 3 chunks, then the 100 ids of the failed chunk one by one
+        self.assertEqual(len(calls), 103)
+        self.assertEqual(sorted(len(ids) for ids in calls if len(ids) > 1), [50, 100, 100])
+
+
+    @mock.patch.object(DisqusQuery, 'change_post_message')
+    @mock.patch.object(DisqusQuery, 'get_posts_list', side_effect=posts_list)
+    def test_save__loaded_post__send_only_changed_fields(self, _, change_message_mock):
+        post_data = POSTS_LIST_RESPONSE['response'][0]
+        post = list(Post.objects.all())[0]
+        post.message = 'edited'
+        with mock.patch.object(DisqusQuery, 'get_post') as get_post_mock:
+            post.save()
+        self.assertEqual(get_post_mock.call_count, 0)
+        change_message_mock.assert_called_once_with(int(post_data['id']), post_data['raw_message'], 'edited')
+        # The snapshot is taken again after saving
+        post.save()
+        change_message_mock.assert_called_once()
+
+    @mock.patch.object(DisqusQuery, 'change_post_message')
+    def test_save__unloaded_post_missing_on_disqus__raise_does_not_exist(self, change_message_mock):
+        post = Post(id=42, message='edited', thread_id=1)
+        with mock.patch.object(DisqusQuery, 'get_post', side_effect=post_detail):
+            with self.assertRaises(Post.DoesNotExist):
+                post.save()
+        self.assertEqual(change_message_mock.call_count, 0)
+
+    @override_settings(DISQUS_OPTIMISTIC_CONCURRENCY=True)
+    @mock.patch.object(DisqusQuery, 'change_post_message')
+    @mock.patch.object(DisqusQuery, 'get_posts_list', side_effect=posts_list)
+    def test_save__remote_changed_after_loading__raise_conflict(self, _, change_message_mock):
+        post_data = POSTS_LIST_RESPONSE['response'][0]
+        post = list(Post.objects.all())[0]
+        post.message = 'edited'
+        remote = {'code': 0, 'response': dict(post_data, raw_message='edited by another moderator')}
+        with mock.patch.object(DisqusQuery.__dict__['get_post'], 'func', return_value=remote):
+            with self.assertRaises(ConcurrentModificationError):
+                post.save()
+        self.assertEqual(change_message_mock.call_count, 0)
+
+    @override_settings(DISQUS_OPTIMISTIC_CONCURRENCY=True)
+    def test_save__remote_changed_after_cached_load__raise_conflict(self):
+        post_data = POSTS_LIST_RESPONSE['response'][0]
+        remote = [dict(post_data, raw_message='original')]
+        requests_sent = []
+
+        def request(model_name, method_name, header, params, timeout=None):
+            requests_sent.append((model_name, method_name))
+            return {'code': 0, 'response': remote[0]}
+
+        with mock.patch.object(DisqusClient, 'request', side_effect=request):
+            # Loaded through the cached `get_post`
+            post = Post.objects.get(pk=post_data['id'])
+            remote[0] = dict(post_data, raw_message='edited by another moderator')
+            post.message = 'edited'
+            with self.assertRaises(ConcurrentModificationError):
+                post.save()
+        self.assertEqual(requests_sent, [('posts', 'details'), ('posts', 'details')])
+
+
+@override_settings(DISQUS_READ_FROM_MIRROR=True)
+class MirrorTest(TestCase):
+    def setUp(self):
+        with mock.patch.object(DisqusQuery, 'get_threads_list', side_effect=threads_list), \
+                mock.patch.object(DisqusQuery, 'get_posts_list', side_effect=posts_list):
+            call_command('disqus_mirror', stdout=six.StringIO())
+
+    def test_read_from_mirror__filter_order_count_slice__answered_by_sql(self):
+        posts_data = POSTS_LIST_RESPONSE['response']
+        approved_ids = sorted((int(p['id']) for p in posts_data if p['isApproved']), reverse=True)
+        with mock.patch.object(DisqusQuery, 'get_posts_list') as posts_list_mock, \
+                mock.patch.object(DisqusQuery, 'get_threads_list') as threads_list_mock:
+            queryset = Post.objects.filter(is_approved=True).order_by('-id')
+            self.assertEqual(queryset.count(), len(approved_ids))
+            self.assertEqual([post.id for post in queryset[1:3]], approved_ids[1:3])
+            self.assertEqual(PostMirror.objects.count(), len(posts_data))
+        self.assertEqual(posts_list_mock.call_count, 0)
+        self.assertEqual(threads_list_mock.call_count, 0)
+
+    def test_write__known_change__applied_to_mirror(self):
+        post_data = POSTS_LIST_RESPONSE['response'][0]
+        with mock.patch.object(DisqusClient, 'request', return_value={'code': 0, 'response': []}):
+            DisqusQuery().spam_posts([post_data['id']])
+            self.assertFalse(PostMirror.objects.get(id=post_data['id']).is_approved)
+            DisqusQuery().delete_thread(post_data['thread'])
+        self.assertFalse(PostMirror.objects.filter(thread_id=post_data['thread']).exists())
+
+    def test_save_rows__many_rows__row_fields_not_rebuilt(self):
+        rows = POSTS_LIST_RESPONSE['response']
+        with mock.patch('disqus_backstore.mirror.get_row_fields') as get_row_fields_mock:
+            get_mirror(Post).save_rows(rows, timezone.now())
+        self.assertEqual(get_row_fields_mock.call_count, 0)
+        self.assertEqual(PostMirror.objects.count(), len(rows))
+
+    def test_patch__many_removed_ids__deleted_in_batches(self):
+        post_ids = [int(p['id']) for p in POSTS_LIST_RESPONSE['response']]
+        mirror = get_mirror(Post)
+        with mock.patch.object(mirror, 'patch_batch_size', 2):
+            mirror.patch(Change('post', post_ids[1:] + list(range(1, 3000)), removed=True))
+        self.assertEqual(list(PostMirror.objects.values_list('id', flat=True)), post_ids[:1])
+
+    def test_restore__deleted_rows__mirrored_again(self):
+        post_data = POSTS_LIST_RESPONSE['response'][0]
+        with mock.patch.object(DisqusClient, 'request', return_value={'code': 0, 'response': []}):
+            DisqusQuery().delete_thread(post_data['thread'])
+        self.assertFalse(PostMirror.objects.filter(thread_id=post_data['thread']).exists())
+        with mock.patch.object(DisqusClient, 'request', return_value={'code': 0, 'response': []}), \
+                mock.patch.object(DisqusQuery, 'get_thread', side_effect=thread_detail), \
+                mock.patch.object(DisqusQuery, 'get_posts_list', side_effect=posts_list):
+            DisqusQuery().recover_thread(post_data['thread'])
+        self.assertTrue(ThreadMirror.objects.filter(id=post_data['thread']).exists())
+        self.assertTrue(PostMirror.objects.filter(id=post_data['id']).exists())
+
+
+class DeltaSyncTest(TestCase):
+    def test_run__crash_between_pages__resume_from_cursor_then_since(self):
+        pages = {
+            None: {'response': [{'id': '1', 'createdAt': '2016-01-01T00:00:00'}],
+                   'cursor': {'hasNext': True, 'next': 'page2'}},
+            'page2': {'response': [{'id': '2', 'createdAt': '2016-01-02T00:00:00'}],
+                      'cursor': {'hasNext': False}},
+        }
+        calls = []
+
+        def posts_list(query, cursor=None, **kwargs):
+            calls.append(dict(kwargs, cursor=cursor))
+            if cursor == 'page2' and len(calls) == 2:
+                raise RequestError("Connection reset")
+            return pages[cursor] if 'since' not in kwargs else {'response': [], 'cursor': {}}
+
+        with mock.patch.object(DisqusQuery.__dict__['get_posts_list'], 'func', side_effect=posts_list):
+            with self.assertRaises(RequestError):
+                DeltaSync('post').run()
+            self.assertEqual(SyncState.objects.get(entity='post').cursor, 'page2')
+            # Resumed from the saved cursor
+            self.assertEqual(DeltaSync('post').run(), 1)
+            self.assertEqual(calls[2]['cursor'], 'page2')
+            # Nothing is new, a single request since the newest row
+            self.assertEqual(DeltaSync('post').run(), 0)
+        self.assertEqual(len(calls), 4)
+        self.assertEqual(calls[3]['since'], '2016-01-02T00:00:00')
+        self.assertEqual(calls[3]['order'], 'asc')
+
+    @override_settings(DISQUS_SEARCH_INDEX_PATH=':memory:')
+    def test_run__rows_at_since_listed_again__skipped_without_invalidation(self):
+        rows = [{'id': '3', 'thread': '1', 'raw_message': 'first', 'createdAt': '2016-01-03T00:00:00'},
+                {'id': '4', 'thread': '1', 'raw_message': 'second', 'createdAt': '2016-01-03T00:00:00'}]
+        calls = []
+
+        def posts_list(query, cursor=None, **kwargs):
+            calls.append(kwargs)
+            # `since` is inclusive
+            return {'response': rows, 'cursor': {'hasNext': False}}
+
+        with mock.patch.object(DisqusQuery.__dict__['get_posts_list'], 'func', side_effect=posts_list), \
+                mock.patch.object(search_index, 'add') as add_mock:
+            self.assertEqual(DeltaSync('post', forum='other').run(), 2)
+            with mock.patch.object(cache_registry, 'clear') as clear_mock:
+                self.assertEqual(DeltaSync('post', forum='other').run(), 0)
+        self.assertEqual(clear_mock.call_count, 0)
+        self.assertEqual(calls[1]['since'], '2016-01-03T00:00:00')
+        self.assertEqual(calls[1]['forum'], 'other')
+        self.assertEqual(SyncState.objects.get(forum='other', entity='post').last_seen_ids, '3,4')
+        add_mock.assert_called_once_with('post', rows)
+
+
+@override_settings(DISQUS_SEARCH_INDEX_PATH=':memory:')
+class SearchTest(TestCase):
+    @mock.patch.object(DisqusQuery, 'get_threads_list', side_effect=threads_list)
+    @mock.patch.object(DisqusQuery, 'get_posts_list', side_effect=posts_list)
+    def test_admin_search__indexed_listing__match_thread_title(self, _, __):
+        posts_data = POSTS_LIST_RESPONSE['response']
+        thread_data = [t for t in THREADS_LIST_RESPONSE['response'] if t['id'] == posts_data[0]['thread']][0]
+        list(Post.objects.all())
+        list(Thread.objects.all())
+        request = RequestFactory().get('/')
+        expected_ids = set(int(p['id']) for p in posts_data if p['thread'] == thread_data['id'])
+
+        queryset, _ = PostAdmin(Post, admin.site).get_search_results(
+            request, Post.objects.all(), thread_data['title'])
+        with mock.patch.object(DisqusQuery, 'get_post', side_effect=post_detail) as get_post_mock:
+            self.assertEqual(set(post.id for post in queryset), expected_ids)
+            # The admin orders by `-pk`, only the details of the page are fetched
+            get_post_mock.reset_mock()
+            self.assertEqual([post.id for post in queryset.order_by('-pk')[:1]], [max(expected_ids)])
+            get_post_mock.assert_called_once_with(max(expected_ids))
+
+        queryset, _ = ThreadAdmin(Thread, admin.site).get_search_results(
+            request, Thread.objects.all(), thread_data['title'])
+        self.assertIn(int(thread_data['id']), queryset.selected_ids())
+
+    def test_count__searched_ids__no_request_and_stale_id_dropped_on_fetch(self):
+        post_data = POSTS_LIST_RESPONSE['response'][0]
+        search_index.add('post', [
+            {'id': post_data['id'], 'raw_message': 'stale count', 'thread': post_data['thread']},
+            {'id': '5', 'raw_message': 'stale count', 'thread': '1'},
+        ])
+        queryset = Post.objects.filter(pk__in=search_index.search('post', 'stale'))
+        with mock.patch.object(DisqusQuery, 'get_post', side_effect=post_detail) as get_post_mock:
+            self.assertEqual(queryset.count(), 2)
+            self.assertEqual(get_post_mock.call_count, 0)
+            self.assertEqual([post.id for post in queryset], [int(post_data['id'])])
+        post_ids = [row[0] for row in search_index.connect().execute('SELECT post_id FROM post_threads')]
+        self.assertIn(int(post_data['id']), post_ids)
+        self.assertNotIn(5, post_ids)
+
+    def test_patch__many_removed_ids__deleted_in_batches(self):
+        search_index.add('post', [{'id': str(i), 'raw_message': 'bulk', 'thread': '1'} for i in range(1, 6)])
+        with mock.patch.object(search_index, 'batch_size', 2):
+            search_index.patch(Change('post', [str(i) for i in range(1, 5)] + list(range(100, 3100)), removed=True))
+        self.assertEqual(search_index.search('post', 'bulk'), [5])
+
+    def test_write__removed_post__dropped_from_index(self):
+        search_index.add('post', [{'id': '5', 'raw_message': 'hello world', 'thread': '1'}])
+        self.assertEqual(search_index.search('post', 'hel'), [5])
+        with mock.patch.object(DisqusClient, 'request', return_value={'code': 0, 'response': []}):
+            DisqusQuery().delete_post('5')
+        self.assertEqual(search_index.search('post', 'hello'), [])
+
+
+class PlannerTest(TestCase):
+    def test_filter__thread_lookup__pushed_to_thread_posts_listing(self):
+        thread_id = int(POSTS_LIST_RESPONSE['response'][1]['thread'])
+        with mock.patch.object(DisqusQuery, 'get_posts_list', side_effect=posts_list) as list_mock:
+            posts = list(Post.objects.filter(thread__id=thread_id)[:1])
+        list_mock.assert_called_once_with(thread_id=thread_id, cursor=None, limit=1)
+        self.assertEqual([post.thread_id for post in posts], [thread_id])
+
+    def test_filter__is_approved_and_date_range__narrow_listing(self):
+        with mock.patch.object(DisqusQuery, 'get_posts_list', side_effect=posts_list) as list_mock:
+            posts = list(Post.objects.filter(
+                is_approved=False,
+                created_at__gte=datetime.datetime(2016, 4, 1),
+            ))
+        self.assertEqual(posts, [])
+        kwargs = list_mock.call_args[1]
+        self.assertEqual(kwargs['include'], ['unapproved', 'spam'])
+        self.assertEqual(kwargs['start'], '2016-04-01T00:00:00')
+
+    def test_filter__forum__sent_to_posts_listing(self):
+        with mock.patch.object(DisqusClient, 'request',
+                               return_value={'code': 0, 'response': [], 'cursor': {}}) as request_mock:
+            self.assertEqual(list(Post.objects.filter(forum='other')), [])
+        self.assertEqual(request_mock.call_args[0][3]['forum'], 'other')
+
+    def test_filter__pk__use_details_api(self):
+        post_data = POSTS_LIST_RESPONSE['response'][0]
+        with mock.patch.object(DisqusQuery, 'get_post', side_effect=post_detail) as detail_mock, \
+                mock.patch.object(DisqusQuery, 'get_posts_list') as list_mock:
+            self.assertEqual(Post.objects.get(pk=post_data['id']).id, int(post_data['id']))
+            self.assertIsNone(Post.objects.filter(forum='other').get(pk=post_data['id']))
+        self.assertEqual(detail_mock.call_count, 2)
+        self.assertEqual(list_mock.call_count, 0)
+
+
+class OrderingTest(TestCase):
+    def test_order_by__created_at__pushed_to_order_parameter(self):
+        with mock.patch.object(DisqusQuery, 'get_threads_list', side_effect=threads_list) as list_mock:
+            list(Thread.objects.order_by('created_at', '-pk')[:5])
+        list_mock.assert_called_once_with(cursor=None, limit=5, order='asc')
+
+    def test_order_by__other_fields__sorted_locally(self):
+        threads_data = THREADS_LIST_RESPONSE['response']
+        expected = sorted(threads_data, key=lambda t: (t['isClosed'], t['title'], int(t['id'])),
+                          reverse=True)
+        with mock.patch.object(DisqusQuery, 'get_threads_list', side_effect=threads_list):
+            objs = list(Thread.objects.order_by('-is_closed', '-title', '-id')[2:5])
+            self.assertEqual([obj.id for obj in objs],
+                             [int(t['id']) for t in expected[2:5]])
+            objs = list(Thread.objects.order_by('title', '-id'))
+            self.assertEqual([obj.title for obj in objs],
+                             sorted(t['title'] for t in threads_data))
+
+
+class FilterTest(TestCase):
+    def filter_ids(self, *args, **kwargs):
+        with mock.patch.object(DisqusQuery, 'get_threads_list', side_effect=threads_list):
+            return [obj.id for obj in Thread.objects.filter(*args, **kwargs)]
+
+    def test_filter__lookups__match_rows(self):
+        threads_data = THREADS_LIST_RESPONSE['response']
+        ids = [int(thread['id']) for thread in threads_data]
+        self.assertEqual(self.filter_ids(pk__in=[str(ids[0]), ids[1]]), ids[:2])
+        self.assertEqual(self.filter_ids(id__gte=ids[1]), ids[:2])
+        self.assertEqual(self.filter_ids(id__lt=ids[-2]), ids[-1:])
+        self.assertEqual(self.filter_ids(is_closed='0'),
+                         [int(thread['id']) for thread in threads_data if not thread['isClosed']])
+        self.assertEqual(self.filter_ids(link__isnull=True), [])
+        self.assertEqual(self.filter_ids(title__startswith=threads_data[0]['title']),
+                         [int(thread['id']) for thread in threads_data
+                          if thread['title'].startswith(threads_data[0]['title'])])
+        self.assertEqual(self.filter_ids(link__icontains=threads_data[0]['link'].upper()),
+                         [ids[0]])
+
+    def test_filter__q_objects__match_rows(self):
+        ids = [int(thread['id']) for thread in THREADS_LIST_RESPONSE['response']]
+        self.assertEqual(self.filter_ids(Q(id=ids[0]) | Q(id=ids[2])), [ids[0], ids[2]])
+        with mock.patch.object(DisqusQuery, 'get_threads_list', side_effect=threads_list):
+            qs = Thread.objects.complex_filter(~Q(id__in=ids[1:]))
+            self.assertEqual([obj.id for obj in qs], ids[:1])
+            qs = Thread.objects.exclude(id=ids[0], is_closed=True)
+            self.assertEqual(len(qs), len(ids))
 
 
 class DisqusQueryTest(TestCase):
     def test_call_disqus_api__response_code_not_zero__raise_exception(self):
         class Error(object):
+            status_code = 200
+            headers = {}
+
             def json(self):
                 error_response = {
                     "code": 7,
                     "response": "It's a DISQUS api error response mock."
                 }
                 return error_response
-        with mock.patch('requests.get', return_value=Error()):
+        with mock.patch.object(requests.Session, 'get', return_value=Error()):
             with self.assertRaises(DISQUSAPIError):
                 send_request_to_disqus("threads", "list", "get", {})
 
+    def test_disqus_client__multiple_requests__reuse_one_session(self):
+        class Success(object):
+            status_code = 200
+            headers = {}
+
+            def json(self):
+                return {"code": 0, "response": []}
+        client = DisqusClient(pool_size=2, timeout=3)
+        query = DisqusQuery(client=client)
+        with mock.patch.object(requests.Session, 'get', return_value=Success()) as get_mock:
+            query.get_thread(1)
+            query.get_post(2)
+        self.assertEqual(get_mock.call_count, 2)
+        self.assertIs(client.session, client.session)
+        for call in get_mock.call_args_list:
+            self.assertEqual(call[1]['timeout'], 3)
+
+    def test_disqus_client__listing_payload__keep_only_model_keys(self):
+        class Success(object):
+            status_code = 200
+            headers = {}
+
+            def json(self):
+                return json.loads(json.dumps(POSTS_LIST_RESPONSE))
+        with mock.patch.object(requests.Session, 'get', return_value=Success()):
+            rows = DisqusClient().request("forums", "listPosts", "get", {})['response']
+        post_data = POSTS_LIST_RESPONSE['response'][0]
+        self.assertNotIn('message', rows[0])
+        self.assertEqual(set(rows[0]['author']), set(['name', 'username']) & set(post_data['author']))
+        self.assertEqual(rows[0]['raw_message'], post_data['raw_message'])
+
+    def test_disqus_client__server_error__retried_with_backoff(self):
+        class Response(object):
+            headers = {}
+
+            def __init__(self, status_code):
+                self.status_code = status_code
+
+            def json(self):
+                return {"code": 0, "response": []}
+        client = DisqusClient(scheduler=RequestScheduler(max_retries=2, backoff_seconds=0))
+        responses = [Response(502), Response(503), Response(200)]
+        with mock.patch.object(requests.Session, 'get', side_effect=responses) as get_mock:
+            self.assertEqual(client.request("threads", "list", "get", {}), {"code": 0, "response": []})
+        self.assertEqual(get_mock.call_count, 3)
+        self.assertEqual(client.scheduler.get_stats()['retries'], 2)
+
+        responses = [Response(500)] * 3
+        with mock.patch.object(requests.Session, 'get', side_effect=responses):
+            with self.assertRaises(RequestError):
+                client.request("threads", "list", "get", {})
+
+    def test_disqus_client__rate_limit_nearly_exhausted__keep_reserve_for_writes(self):
+        class Response(object):
+            status_code = 200
+            headers = {
+                'X-Ratelimit-Remaining': '10',
+                'X-Ratelimit-Reset': str(time.time() + 3600),
+            }
+
+            def json(self):
+                return {"code": 0, "response": []}
+        client = DisqusClient(scheduler=RequestScheduler(reserve=10, max_wait=0))
+        with mock.patch.object(requests.Session, 'get', return_value=Response()):
+            client.request("threads", "list", "get", {})
+            with self.assertRaises(RateLimitExceeded):
+                client.request("threads", "list", "get", {})
+        with mock.patch.object(requests.Session, 'post', return_value=Response()) as post_mock:
+            client.request("threads", "close", "post", {})
+        self.assertEqual(post_mock.call_count, 1)
+        self.assertEqual(client.scheduler.get_stats()['rejected'], 1)
+
+    def test_scheduler__budget_used_up_without_reset_time__wait_without_spinning(self):
+        scheduler = RequestScheduler(reserve=10, max_wait=0.3, backoff_seconds=0.1)
+        scheduler.remaining = 5
+        with mock.patch.object(scheduler.condition, 'wait', wraps=scheduler.condition.wait) as wait_mock:
+            self.assertFalse(scheduler.acquire())
+        self.assertLessEqual(wait_mock.call_count, 4)
+
+    def test_disqus_client__write_timeout__not_retried(self):
+        client = DisqusClient(scheduler=RequestScheduler(max_retries=2, backoff_seconds=0))
+        with mock.patch.object(requests.Session, 'post', side_effect=requests.ReadTimeout()) as post_mock:
+            with self.assertRaises(RequestError):
+                client.request("posts", "remove", "post", {})
+        self.assertEqual(post_mock.call_count, 1)
+        # The request hasn't been sent when connecting times out
+        with mock.patch.object(requests.Session, 'post', side_effect=requests.ConnectTimeout()) as post_mock:
+            with self.assertRaises(RequestError):
+                client.request("posts", "remove", "post", {})
+        self.assertEqual(post_mock.call_count, 3)
+
+    def test_run_in_chunks__priority_of_caller__used_by_workers(self):
+        priorities = []
+
+        def remove(post_ids):
+            priorities.append(current_priority(None))
+
+        query = DisqusQuery()
+        with request_priority(BACKGROUND):
+            query.run_in_chunks(remove, list(range(4)), chunk_size=1)
+        self.assertEqual(priorities, [BACKGROUND] * 4)
+
+    @unittest.skipIf(six.PY2, "asyncio requires Python 3")
+    def test_async_query__concurrent_details__share_identical_calls(self):
+        import asyncio
+        from .aio import AsyncDisqusQuery
+        requested = []
+
+        class Client(object):
+            def request(self, model_name, method_name, header, params, timeout=None):
+                requested.append(params['thread'])
+                return asyncio.sleep(0.01, result={'code': 0, 'response': {'id': params['thread']}})
+
+        query = AsyncDisqusQuery(client=Client())
+        loop = asyncio.new_event_loop()
+        try:
+            results = loop.run_until_complete(query.get_threads([101, 102, 101]))
+        finally:
+            loop.close()
+        self.assertEqual([r['response']['id'] for r in results], [101, 102, 101])
+        self.assertEqual(sorted(requested), [101, 102])
+
+    @unittest.skipIf(six.PY2, "asyncio requires Python 3")
+    def test_async_client__rate_limit_code__raise_rate_limit_exceeded(self):
+        import asyncio
+        from .aio import AsyncDisqusClient, AsyncDisqusQuery
+        body = json.dumps({'code': 13, 'response': "You have exceeded your hourly limit of requests"})
+
+        class Response(object):
+            status = 200
+            headers = {}
+
+            def __aenter__(self):
+                return asyncio.sleep(0, result=self)
+
+            def __aexit__(self, *args):
+                return asyncio.sleep(0)
+
+            def read(self):
+                return asyncio.sleep(0, result=body.encode('utf-8'))
+
+            def json(self, content_type=None):
+                return asyncio.sleep(0, result=json.loads(body))
+
+        scheduler = RequestScheduler()
+        client = AsyncDisqusClient(scheduler=scheduler)
+        query = AsyncDisqusQuery(client=client)
+        session = mock.Mock(closed=False, request=mock.Mock(return_value=Response()))
+        loop = asyncio.new_event_loop()
+        try:
+            with mock.patch('aiohttp.ClientSession', return_value=session):
+                with self.assertRaises(RateLimitExceeded):
+                    loop.run_until_complete(query.fetch_detail('thread', 104))
+                # The quota is used up, the next request isn't sent
+                with self.assertRaises(RateLimitExceeded):
+                    loop.run_until_complete(client.request('threads', 'details', 'get', {'thread': 105}))
+        finally:
+            loop.close()
+        self.assertEqual(session.request.call_count, 1)
+        self.assertEqual(scheduler.get_stats()['remaining'], 0)
+
+    @unittest.skipIf(six.PY2, "asyncio requires Python 3")
+    def test_async_client__second_event_loop__gets_its_own_session(self):
+        import asyncio
+        from .aio import AsyncDisqusClient
+        client = AsyncDisqusClient()
+
+        def get_state(loop):
+            state = loop.create_future()
+            loop.call_soon(lambda: state.set_result((client.session, client.semaphore)))
+            return loop.run_until_complete(state)
+
+        sessions = []
+        for _ in range(2):
+            loop = asyncio.new_event_loop()
+            try:
+                session, semaphore = get_state(loop)
+                self.assertFalse(session.closed)
+                sessions.append(session)
+                loop.run_until_complete(client.close())
+            finally:
+                loop.close()
+        self.assertIsNot(sessions[0], sessions[1])
+
+    @unittest.skipIf(six.PY2, "asyncio requires Python 3")
+    def test_async_query__cache_changed_while_fetching__result_not_saved(self):
+        import asyncio
+        from .aio import AsyncDisqusQuery
+
+        class Client(object):
+            def request(self, model_name, method_name, header, params, timeout=None):
+                # A write operation happens during the request
+                cache_registry.clear('thread')
+                return asyncio.sleep(0, result={'code': 0, 'response': {'id': params['thread']}})
+
+        query = AsyncDisqusQuery(client=Client())
+        loop = asyncio.new_event_loop()
+        try:
+            result = loop.run_until_complete(query.get_thread(103))
+        finally:
+            loop.close()
+        self.assertEqual(result['response']['id'], 103)
+        store, key, record = DisqusQuery.__dict__['get_thread'].lookup((103,), {})
+        self.assertIsNone(record)
+
 
 class UtilsTest(TestCase):
     def test_query_cache__no_parameter__works(self):
@@ -566,3 +1402,198 @@ class UtilsTest(TestCase):
         y1 = api.get_thread(1)
         y2 = api.get_thread(1)
         self.assertEqual(y2, "thread_1_2")
+
+    def test_query_cache__unhashable_and_reordered_kwargs__same_key(self):
+        class API(object):
+            version = 0
+
+            @query_cache('thread')
+            def get_posts(self, **kwargs):
+                self.version += 1
+                return self.version
+
+        api = API()
+        y1 = api.get_posts(include=['approved'], limit=100)
+        y2 = api.get_posts(limit=100, include=['approved'])
+        self.assertEqual(y1, y2)
+
+    @override_settings(DISQUS_QUERY_CACHE='default')
+    def test_query_cache__django_cache_alias__shared_and_cleared_by_version(self):
+        def make_api():
+            # Two classes with the same method play two worker processes
+            class API(object):
+                version = 0
+
+                @query_cache('shared_thread')
+                def get_thread(self, thread_id):
+                    self.version += 1
+                    return 'thread_{id}_{version}'.format(id=thread_id, version=self.version)
+            return API()
+
+        worker1, worker2 = make_api(), make_api()
+        self.assertEqual(worker1.get_thread(1), 'thread_1_1')
+        self.assertEqual(worker2.get_thread(1), 'thread_1_1')
+        self.assertEqual(worker2.version, 0)
+        cache_registry.clear('shared_thread')
+        self.assertEqual(worker2.get_thread(1), 'thread_1_1')
+        self.assertEqual(worker2.version, 1)
+
+    def test_query_record__outdated_more_than_one_day__is_outdated(self):
+        record = QueryRecord('result', 5)
+        record.timestamp -= datetime.timedelta(days=1, seconds=1)
+        self.assertTrue(record.is_outdated())
+
+    def test_local_cache_store__over_limits__evict_least_recently_used(self):
+        store = LocalCacheStore(max_entries=2)
+        for key in ['a', 'b']:
+            store.set(key, QueryRecord(key, 5))
+        store.get('a')
+        store.set('c', QueryRecord('c', 5))
+        self.assertEqual(list(store.records), ['a', 'c'])
+
+        store = LocalCacheStore(max_bytes=1)
+        store.set('a', QueryRecord('a', 5))
+        self.assertEqual(len(store.records), 0)
+        self.assertEqual(store.total_bytes, 0)
+
+    def test_local_cache_store__outdated_records__swept(self):
+        store = LocalCacheStore()
+        store.set('a', QueryRecord('a', 5))
+        store.records['a'].timestamp -= datetime.timedelta(seconds=10)
+        store.set('b', QueryRecord('b', 5))
+        store.sweep(force=True)
+        self.assertEqual(list(store.records), ['b'])
+
+    def test_cache_patcher__write_known_change__patch_only_related_records(self):
+        class API(object):
+            calls = 0
+
+            @query_cache('post')
+            def get_posts_list(self, **kwargs):
+                self.calls += 1
+                return {'response': [
+                    {'id': '1', 'thread': '10', 'isApproved': False},
+                    {'id': '2', 'thread': '20', 'isApproved': False},
+                ]}
+
+            @cache_patcher(['post'], 'post', fields={'isApproved': True}, filtered_by=['include'])
+            def approve_post(self, post_id):
+                pass
+
+            @cache_patcher(['post'], 'post', removed=True)
+            def delete_post(self, post_id):
+                pass
+
+        api = API()
+        api.get_posts_list()
+        api.get_posts_list(include=['unapproved'])
+        self.assertEqual(api.calls, 2)
+
+        api.approve_post(1)
+        rows = api.get_posts_list()['response']
+        self.assertEqual(api.calls, 2)
+        self.assertEqual([row['isApproved'] for row in rows], [True, False])
+        # The filtered listing can't be patched
+        api.get_posts_list(include=['unapproved'])
+        self.assertEqual(api.calls, 3)
+
+        api.delete_post(2)
+        rows = api.get_posts_list()['response']
+        self.assertEqual(api.calls, 3)
+        self.assertEqual([row['id'] for row in rows], ['1'])
+
+    def test_query_cache__stale_record_in_grace_window__refreshed_in_background(self):
+        class API(object):
+            version = 0
+
+            @query_cache('thread', refreshed_seconds=5, stale_seconds=60)
+            def get_thread(self, thread_id):
+                self.version += 1
+                return 'thread_{id}_{version}'.format(id=thread_id, version=self.version)
+
+        api = API()
+        self.assertEqual(api.get_thread(1), 'thread_1_1')
+        age_records(API.__dict__['get_thread'].local_store, 10)
+        # Outdated but in the grace window, the stale result is returned
+        self.assertEqual(api.get_thread(1), 'thread_1_1')
+        background_refresher.wait()
+        self.assertEqual(api.get_thread(1), 'thread_1_2')
+
+        age_records(API.__dict__['get_thread'].local_store, 100)
+        # Over the max staleness, it's fetched synchronously
+        self.assertEqual(api.get_thread(1), 'thread_1_3')
+
+    def test_query_cache__request_error__serve_expired_record(self):
+        class API(object):
+            fail = False
+
+            @query_cache('thread', refreshed_seconds=5)
+            def get_thread(self, thread_id):
+                if self.fail:
+                    raise RateLimitExceeded("The Disqus rate limit is exhausted.")
+                return 'thread_{id}'.format(id=thread_id)
+
+        api = API()
+        self.assertEqual(api.get_thread(1), 'thread_1')
+        age_records(API.__dict__['get_thread'].local_store, 10)
+        api.fail = True
+        self.assertEqual(api.get_thread(1), 'thread_1')
+        with self.assertRaises(RateLimitExceeded):
+            api.get_thread(2)
+
+    def test_cache_registry__deferred__merge_changes_until_the_end(self):
+        cache = mock.Mock()
+        registry = CacheRegistry()
+        registry.register('post', cache)
+        with registry.deferred():
+            registry.patch('post', Change('post', ['1', '2'], removed=True))
+            registry.patch('post', Change('post', ['3'], removed=True))
+            self.assertEqual(cache.patch.call_count, 0)
+        cache.patch.assert_called_once()
+        self.assertEqual(cache.patch.call_args[0][0].ids, set(['1', '2', '3']))
+
+    def test_cache_registry__deferred__hold_only_the_bound_threads(self):
+        cache = mock.Mock()
+        registry = CacheRegistry()
+        registry.register('post', cache)
+        with registry.deferred():
+            bound = threading.Thread(target=registry.bind(
+                lambda: registry.patch('post', Change('post', ['1'], removed=True))))
+            other = threading.Thread(target=lambda: registry.clear('post'))
+            for thread in (bound, other):
+                thread.start()
+                thread.join()
+            cache.clear.assert_called_once_with()
+            self.assertEqual(cache.patch.call_count, 0)
+        cache.patch.assert_called_once()
+        self.assertEqual(cache.patch.call_args[0][0].ids, set(['1']))
+
+    def test_single_flight__concurrent_calls__share_one_call(self):
+        single_flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def slow_call():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return 'result'
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(single_flight.do('key', slow_call)))
+        leader.start()
+        started.wait()
+        followers = [threading.Thread(target=lambda: results.append(single_flight.do('key', slow_call)))
+                     for _ in range(3)]
+        try:
+            for follower in followers:
+                follower.start()
+            # Give the followers time to join the in-flight call
+            time.sleep(0.1)
+        finally:
+            release.set()
+        for thread in [leader] + followers:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['result'] * 4)
@@ -1,4 +1,24 @@
+import bisect
+import contextlib
+import hashlib
+import json
+import logging
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
 from django.utils import timezone
+from django.utils.encoding import force_bytes
+from django.utils.six.moves import queue
+
+from .exceptions import RequestError
+from .scheduler import BACKGROUND, request_priority
+
+logger = logging.getLogger(__name__)
+
 
 class QueryNotRegistered(Exception):
     pass
@@ -16,6 +36,8 @@ class CacheRegistry(object):
     def __init__(self):
         # query_category -> set of related query cache
         self.query_categories = dict()
+        # The invalidation batch collected by the current thread
+        self.local = threading.local()
 
     def register(self, category, query_cache):
         if category not in self.query_categories:
@@ -23,17 +45,207 @@ class CacheRegistry(object):
         self.query_categories[category].add(query_cache)
 
     def clear(self, query_cache_category):
-        try:
-            for cache in self.query_categories[query_cache_category]:
-                cache.clear()
-        except KeyError:
+        if query_cache_category not in self.query_categories:
             raise QueryNotRegistered("Category {category} isn't registered.".format(category=query_cache_category))
+        batch = getattr(self.local, 'batch', None)
+        if batch is not None:
+            batch.clear(query_cache_category)
+            return
+        for cache in self.query_categories[query_cache_category]:
+            cache.clear()
+
+    def patch(self, query_cache_category, change):
+        if query_cache_category not in self.query_categories:
+            raise QueryNotRegistered("Category {category} isn't registered.".format(category=query_cache_category))
+        batch = getattr(self.local, 'batch', None)
+        if batch is not None:
+            batch.patch(query_cache_category, change)
+            return
+        for cache in self.query_categories[query_cache_category]:
+            cache.patch(change)
+
+    def restore(self, query_cache_category, entity, ids):
+        """
+        Tell the caches which keep their own copy of the rows,
+        ex. the local mirror, that the deleted entities are restored.
+        """
+        if query_cache_category not in self.query_categories:
+            raise QueryNotRegistered("Category {category} isn't registered.".format(category=query_cache_category))
+        batch = getattr(self.local, 'batch', None)
+        if batch is not None:
+            batch.restore(query_cache_category, entity, ids)
+            return
+        for cache in self.query_categories[query_cache_category]:
+            restore = getattr(cache, 'restore', None)
+            if restore is not None:
+                restore(entity, ids)
+
+    @contextlib.contextmanager
+    def deferred(self):
+        """
+        Hold the invalidation of the caches made by the current thread
+        in the block, and by the functions passed to `bind` in it, and
+        apply it once at the end. The changes of the same kind are merged,
+        ex. all posts removed by a batch of `delete_posts` calls.
+        The invalidation of other threads isn't held.
+        """
+        batch = getattr(self.local, 'batch', None)
+        if batch is not None:
+            # Nested block, the outermost one applies the batch
+            yield batch
+            return
+        batch = self.local.batch = InvalidationBatch()
+        try:
+            yield batch
+        finally:
+            self.local.batch = None
+            clears, changes, restores = batch.pop()
+            for category in clears:
+                self.clear(category)
+            for (category, _), change in changes.items():
+                if category not in clears:
+                    self.patch(category, change)
+            for category, entity, ids in restores:
+                self.restore(category, entity, ids)
+
+    def bind(self, func):
+        """
+        Wrap `func` to collect its invalidation into the batch of the
+        current thread, so it can run in another thread, ex. a pool worker.
+        """
+        batch = getattr(self.local, 'batch', None)
+        if batch is None:
+            return func
+
+        def bound(*args, **kwargs):
+            previous = getattr(self.local, 'batch', None)
+            self.local.batch = batch
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.local.batch = previous
+        return bound
+
+
+class InvalidationBatch(object):
+    """
+    The cache invalidation collected by `CacheRegistry.deferred`.
+    It can be filled by several threads of the same operation.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clears = set()
+        # (category, change key) -> change
+        self.changes = OrderedDict()
+        # (category, entity, ids) of the restored entities
+        self.restores = []
+
+    def clear(self, category):
+        with self.lock:
+            self.clears.add(category)
+
+    def patch(self, category, change):
+        key = (category, change.merge_key)
+        with self.lock:
+            if key in self.changes:
+                self.changes[key].ids.update(change.ids)
+            else:
+                self.changes[key] = change
+
+    def restore(self, category, entity, ids):
+        with self.lock:
+            self.restores.append((category, entity, ids))
+
+    def pop(self):
+        with self.lock:
+            clears, self.clears = self.clears, set()
+            changes, self.changes = self.changes, OrderedDict()
+            restores, self.restores = self.restores, []
+        return clears, changes, restores
 
 
 cache_registry = CacheRegistry()
 
 
-def cache_clearer(query_categories):
+class Change(object):
+    """
+    A known change of Disqus entities made by a write operation.
+    `entity` is `thread` or `post`, `fields` maps the keys of API rows to
+    their new values, and `removed` means the entities are deleted.
+    The cached listings requested with any parameter in `filtered_by`
+    may gain or lose rows by the change, so they can't be patched.
+    """
+    def __init__(self, entity, ids, fields=None, removed=False, filtered_by=()):
+        if not isinstance(ids, (list, tuple, set)):
+            ids = [ids]
+        self.entity = entity
+        self.ids = set(str(entity_id) for entity_id in ids)
+        self.fields = fields or {}
+        self.removed = removed
+        self.filtered_by = set(filtered_by)
+
+    @property
+    def merge_key(self):
+        """The changes with the same key only differ in their ids"""
+        return (self.entity, self.removed, repr(sorted(self.fields.items())),
+                tuple(sorted(self.filtered_by)))
+
+    def matches(self, category, row):
+        """
+        Whether the row of a `category` listing is changed. The posts
+        of a removed thread are removed too.
+        """
+        if category == self.entity:
+            return row.get('id') in self.ids
+        return self.removed and self.entity == 'thread' and row.get('thread') in self.ids
+
+    def apply(self, category, result):
+        """
+        Return the patched copy of a cached API result,
+        or None if the result is a removed entity itself.
+        """
+        response = result.get('response')
+        if isinstance(response, dict):
+            if not self.matches(category, response):
+                return result
+            if self.removed:
+                return None
+            return dict(result, response=dict(response, **self.fields))
+        rows = []
+        for row in response:
+            if not self.matches(category, row):
+                rows.append(row)
+            elif not self.removed:
+                rows.append(dict(row, **self.fields))
+        return dict(result, response=rows)
+
+
+def get_entity_keys(category, result):
+    """
+    Return the `(entity, id)` pairs referenced by a cached API result.
+    """
+    response = result.get('response') if isinstance(result, dict) else None
+    if isinstance(response, dict):
+        response = [response]
+    if not isinstance(response, list):
+        return set()
+    entity_keys = set()
+    for row in response:
+        if isinstance(row, dict) and 'id' in row:
+            entity_keys.add((category, row['id']))
+            if 'thread' in row:
+                entity_keys.add(('thread', row['thread']))
+    return entity_keys
+
+
+def cache_clearer(query_categories, restored=None):
+    """
+    A decorator for write operations whose change can't be patched,
+    the caches of `query_categories` are cleared. If the operation
+    restores deleted entities of the `restored` entity, their ids are
+    the first argument of the decorated method, and they're passed to
+    `cache_registry.restore` after the caches are cleared.
+    """
     class CacheClearer(object):
         def __init__(self, func, *args, **kwargs):
             self.func = func
@@ -43,6 +255,12 @@ def cache_clearer(query_categories):
             result = self.func(*args, **kwargs)
             for query_category in self.query_categories:
                 cache_registry.clear(query_category)
+            if restored is not None:
+                entity_ids = args[1]
+                if not isinstance(entity_ids, (list, tuple, set)):
+                    entity_ids = [entity_ids]
+                for query_category in self.query_categories:
+                    cache_registry.restore(query_category, restored, list(entity_ids))
             return result
 
         def __get__(self, instance, owner):
@@ -53,19 +271,401 @@ def cache_clearer(query_categories):
 
     return CacheClearer
 
+
+def cache_patcher(query_categories, entity, fields=None, removed=False, filtered_by=()):
+    """
+    A decorator for write operations whose change is known, ex. approving
+    a post. Instead of clearing whole categories like `cache_clearer`,
+    only the cached results referencing the changed entities are patched
+    in place. The first argument of the decorated method is the entity
+    id or list of ids, and `fields` can be a function of the arguments
+    which returns the changed fields.
+    """
+    class CachePatcher(object):
+        def __init__(self, func, *args, **kwargs):
+            self.func = func
+            self.query_categories = query_categories
+
+        def __call__(self, instance, entity_ids, *args, **kwargs):
+            result = self.func(instance, entity_ids, *args, **kwargs)
+            changed_fields = fields(entity_ids, *args, **kwargs) if callable(fields) else fields
+            change = Change(entity, entity_ids, changed_fields, removed, filtered_by)
+            for query_category in self.query_categories:
+                cache_registry.patch(query_category, change)
+            return result
+
+        def __get__(self, instance, owner):
+            def f(*args, **kwargs):
+                return self(instance, *args, **kwargs)
+            return f
+
+    return CachePatcher
+
+
 class QueryRecord(object):
-    def __init__(self, result, refreshed_seconds):
+    def __init__(self, result, refreshed_seconds, arg_names=(), stale_seconds=0, error_seconds=0):
         self.result = result
         self.timestamp = timezone.now()
         self.refreshed_seconds = refreshed_seconds
+        # The keyword arguments of the call, to know how it's filtered
+        self.arg_names = frozenset(arg_names)
+        # How long an outdated record can still be served while refreshing
+        self.stale_seconds = stale_seconds
+        # How long an expired record is kept to be served when Disqus fails
+        self.error_seconds = error_seconds
 
     def is_outdated(self, thres_seconds=None):
         if thres_seconds is None:
             thres_seconds = self.refreshed_seconds
         time_delta = timezone.now() - self.timestamp
-        return time_delta.seconds > thres_seconds
+        return time_delta.total_seconds() > thres_seconds
+
+    def is_expired(self):
+        return self.is_outdated(self.refreshed_seconds + self.stale_seconds)
+
+    def is_dead(self):
+        return self.is_outdated(self.timeout)
+
+    @property
+    def timeout(self):
+        return self.refreshed_seconds + self.stale_seconds + self.error_seconds
+
+
+class BackgroundRefresher(object):
+    """
+    A daemon thread which refreshes outdated `query_cache` records,
+    so the callers in stale-while-revalidate mode never wait for them.
+    A key which is already waiting for refreshing isn't queued again.
+    """
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def submit(self, key, func):
+        with self.lock:
+            if key in self.pending:
+                return
+            self.pending.add(key)
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='disqus-cache-refresher')
+                self.thread.daemon = True
+                self.thread.start()
+        self.queue.put((key, func))
+
+    def run(self):
+        while True:
+            key, func = self.queue.get()
+            try:
+                with request_priority(BACKGROUND):
+                    func()
+            except Exception:
+                logger.exception("Failed to refresh the cached Disqus query %s", key)
+            finally:
+                with self.lock:
+                    self.pending.discard(key)
+                self.queue.task_done()
+
+    def wait(self):
+        self.queue.join()
+
+
+background_refresher = BackgroundRefresher()
+
+
+def approximate_size(obj):
+    """
+    Approximate memory size in bytes of a decoded JSON response,
+    counting every nested container and value once.
+    """
+    size = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple)):
+            stack.extend(obj)
+    return size
+
+def make_cache_key(args, kwargs):
+    """
+    Serialize the call arguments into a canonical string. It doesn't
+    depend on the order of kwargs and works with unhashable arguments
+    like the `include` list of Disqus API.
+    """
+    return json.dumps([args, kwargs], sort_keys=True, default=repr, separators=(',', ':'))
+
 
-def query_cache(category, refreshed_seconds=5):
+_local = threading.local()
+
+
+@contextlib.contextmanager
+def saving_skipped():
+    """
+    Don't save the results fetched by `query_cache` in the block, ex. the
+    pages walked by a count, which would push the useful records out of
+    the store. The fresh cached results are still served.
+    """
+    previous = getattr(_local, 'saving_skipped', False)
+    _local.saving_skipped = True
+    try:
+        yield
+    finally:
+        _local.saving_skipped = previous
+
+
+class LocalCacheStore(object):
+    """
+    The default store of `query_cache`, a dict in the current process.
+    It's bounded by `max_entries` records and `max_bytes` approximate
+    bytes of results, the least recently used records are evicted first.
+    Outdated records are dropped once they are read, and all of them
+    are swept at most every `sweep_seconds` when a record is saved.
+    The keys are indexed by the entities referenced in the results,
+    so a `Change` only touches the records which contain them.
+    """
+    def __init__(self, max_entries=None, max_bytes=None, sweep_seconds=60):
+        self.max_entries = max_entries or getattr(settings, 'DISQUS_QUERY_CACHE_MAX_ENTRIES', 256)
+        self.max_bytes = max_bytes or getattr(settings, 'DISQUS_QUERY_CACHE_MAX_BYTES', 64 * 1024 * 1024)
+        self.sweep_seconds = sweep_seconds
+        self.clear()
+
+    def get(self, key):
+        record = self.records.get(key, None)
+        if record is None:
+            return None
+        if record.is_dead():
+            self.delete(key)
+            return None
+        # Move it to the most recently used end
+        del self.records[key]
+        self.records[key] = record
+        return record
+
+    def set(self, key, record, category=None):
+        self.delete(key)
+        if record.refreshed_seconds < 0:
+            return
+        self.sweep()
+        size = approximate_size(record.result)
+        self.records[key] = record
+        self.sizes[key] = size
+        self.total_bytes += size
+        entity_keys = get_entity_keys(category, record.result)
+        self.entity_keys[key] = entity_keys
+        for entity_key in entity_keys:
+            self.index.setdefault(entity_key, set()).add(key)
+        while self.records and (len(self.records) > self.max_entries or
+                                self.total_bytes > self.max_bytes):
+            self.delete(next(iter(self.records)))
+
+    def delete(self, key):
+        if key in self.records:
+            del self.records[key]
+            self.total_bytes -= self.sizes.pop(key)
+            for entity_key in self.entity_keys.pop(key, ()):
+                keys = self.index.get(entity_key)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self.index[entity_key]
+
+    def patch(self, category, change):
+        self._generation += 1
+        keys = set()
+        for entity_id in change.ids:
+            keys.update(self.index.get((change.entity, entity_id), ()))
+        for key in keys:
+            record = self.records[key]
+            if change.fields and record.arg_names & change.filtered_by:
+                self.delete(key)
+                continue
+            result = change.apply(category, record.result)
+            if result is None:
+                self.delete(key)
+                continue
+            patched = QueryRecord(result, record.refreshed_seconds, record.arg_names,
+                                  record.stale_seconds, record.error_seconds)
+            patched.timestamp = record.timestamp
+            self.records[key] = patched
+            size = approximate_size(result)
+            self.total_bytes += size - self.sizes[key]
+            self.sizes[key] = size
+
+    def sweep(self, force=False):
+        now = time.time()
+        if not force and now - self.last_sweep < self.sweep_seconds:
+            return
+        self.last_sweep = now
+        for key, record in list(self.records.items()):
+            if record.is_dead():
+                self.delete(key)
+
+    @property
+    def generation(self):
+        return self._generation
+
+    def clear(self):
+        self._generation = getattr(self, '_generation', 0) + 1
+        self.records = OrderedDict()
+        self.sizes = dict()
+        # key -> (entity, id) pairs, and (entity, id) -> keys
+        self.entity_keys = dict()
+        self.index = dict()
+        self.total_bytes = 0
+        self.last_sweep = time.time()
+
+
+class ShardedCacheStore(object):
+    """
+    A thread-safe `LocalCacheStore` split into `shards`, each guarded by
+    its own lock. A key always lives in the same shard, so threads
+    reading or writing different keys rarely wait for each other.
+    The limits of entries and bytes are divided between the shards.
+    """
+    def __init__(self, shards=16, max_entries=None, max_bytes=None):
+        max_entries = max_entries or getattr(settings, 'DISQUS_QUERY_CACHE_MAX_ENTRIES', 256)
+        max_bytes = max_bytes or getattr(settings, 'DISQUS_QUERY_CACHE_MAX_BYTES', 64 * 1024 * 1024)
+        self.shards = [
+            LocalCacheStore(max(max_entries // shards, 1), max(max_bytes // shards, 1))
+            for _ in range(shards)
+        ]
+        self.locks = [threading.Lock() for _ in range(shards)]
+        self.generation_lock = threading.Lock()
+        self.generation = 0
+
+    def get_shard(self, key):
+        index = hash(key) % len(self.shards)
+        return self.shards[index], self.locks[index]
+
+    def get(self, key):
+        shard, lock = self.get_shard(key)
+        with lock:
+            return shard.get(key)
+
+    def set(self, key, record, category=None):
+        shard, lock = self.get_shard(key)
+        with lock:
+            shard.set(key, record, category)
+
+    def patch(self, category, change):
+        with self.generation_lock:
+            self.generation += 1
+        for shard, lock in zip(self.shards, self.locks):
+            with lock:
+                shard.patch(category, change)
+
+    def clear(self):
+        with self.generation_lock:
+            self.generation += 1
+        for shard, lock in zip(self.shards, self.locks):
+            with lock:
+                shard.clear()
+
+
+class SingleFlight(object):
+    """
+    Coalesce concurrent calls of the same key, only the first caller runs
+    the function and the others wait for its result or exception.
+    The in-flight calls are kept in lock-striped dicts.
+    """
+    class Call(object):
+        def __init__(self):
+            self.event = threading.Event()
+            self.result = None
+            self.exception = None
+
+        def wait(self):
+            self.event.wait()
+            if self.exception is not None:
+                raise self.exception
+            return self.result
+
+    def __init__(self, stripes=16):
+        self.locks = [threading.Lock() for _ in range(stripes)]
+        self.calls = [dict() for _ in range(stripes)]
+
+    def do(self, key, func):
+        index = hash(key) % len(self.locks)
+        lock, calls = self.locks[index], self.calls[index]
+        with lock:
+            call = calls.get(key)
+            leader = call is None
+            if leader:
+                call = calls[key] = self.Call()
+        if not leader:
+            return call.wait()
+        try:
+            call.result = func()
+            return call.result
+        except Exception as e:
+            call.exception = e
+            raise
+        finally:
+            with lock:
+                del calls[key]
+            call.event.set()
+
+
+class DjangoCacheStore(object):
+    """
+    A store of `query_cache` backed by a django `CACHES` alias,
+    so every worker process shares the same records.
+    Keys are the sha1 of `make_cache_key`.
+    Clearing only bumps the version of the namespace, the records of old
+    versions are never read again and expire by themselves.
+    """
+    def __init__(self, alias, namespace):
+        self.alias = alias
+        self.namespace = namespace
+        self.version_key = 'disqus_backstore:{namespace}:version'.format(namespace=namespace)
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def get_version(self):
+        version = self.cache.get(self.version_key)
+        if version is None:
+            self.cache.add(self.version_key, 1, None)
+            version = self.cache.get(self.version_key, 1)
+        return version
+
+    def make_key(self, key):
+        return 'disqus_backstore:{namespace}:{version}:{digest}'.format(
+            namespace=self.namespace,
+            version=self.get_version(),
+            digest=hashlib.sha1(force_bytes(key)).hexdigest(),
+        )
+
+    def get(self, key):
+        return self.cache.get(self.make_key(key))
+
+    @property
+    def generation(self):
+        return self.get_version()
+
+    def set(self, key, record, category=None):
+        if record.timeout > 0:
+            self.cache.set(self.make_key(key), record, record.timeout)
+
+    def patch(self, category, change):
+        # The shared records aren't indexed by entity
+        self.clear()
+
+    def clear(self):
+        try:
+            self.cache.incr(self.version_key)
+        except ValueError:
+            # The version key is missing, so every old key is unreachable anyway
+            self.cache.add(self.version_key, 1, None)
+
+
+def query_cache(category, refreshed_seconds=5, stale_seconds=None):
     """
     A decorator for caching query API result.
     For each call we use the arguments as key.
@@ -75,26 +675,108 @@ def query_cache(category, refreshed_seconds=5):
     with `cache_clearer` decorator can get the registry. Once writing
     operation occurs, `cache_clearer` will ask `cache_registry` to
     clear the corresponding cache.
+    The records are saved in the current process by default. Set
+    `DISQUS_QUERY_CACHE` to a django `CACHES` alias to share them
+    between processes.
+    Within `stale_seconds` (or `DISQUS_QUERY_CACHE_STALE_SECONDS`) after
+    a record is outdated, it's still returned right away while
+    `background_refresher` fetches the new result. Records older than that
+    are fetched synchronously.
+    Concurrent calls missing the same key share one request.
+    If Disqus fails or the rate limit is exhausted, an expired record is
+    still served within `DISQUS_QUERY_CACHE_ERROR_SECONDS`.
     """
     class QueryCache(object):
         def __init__(self, func):
-            self.call_record = dict()
+            self.local_store = ShardedCacheStore()
+            self.shared_stores = dict()
+            self.single_flight = SingleFlight()
             self.func = func
             self.name = getattr(func, 'name', func.__name__)
+            self.namespace = '{module}.{name}'.format(module=func.__module__, name=self.name)
             self.refreshed_seconds = refreshed_seconds
             cache_registry.register(category, self)
 
-        def __call__(self, *args, **kwargs):
-            args_record = tuple(args)
-            kwargs_record = tuple(kwargs.items())
-            all_args = (args_record, kwargs_record)
-            record = self.call_record.get(all_args, None)
+        @property
+        def store(self):
+            alias = getattr(settings, 'DISQUS_QUERY_CACHE', None)
+            if alias is None:
+                return self.local_store
+            if alias not in self.shared_stores:
+                self.shared_stores[alias] = DjangoCacheStore(alias, self.namespace)
+            return self.shared_stores[alias]
+
+        @property
+        def stale_seconds(self):
+            if stale_seconds is not None:
+                return stale_seconds
+            return getattr(settings, 'DISQUS_QUERY_CACHE_STALE_SECONDS', 0)
+
+        @property
+        def error_seconds(self):
+            return getattr(settings, 'DISQUS_QUERY_CACHE_ERROR_SECONDS', 600)
+
+        def __call__(self, instance, *args, **kwargs):
+            # The instance is the `self` of the decorated method,
+            # it's not a part of the key.
+            key = make_cache_key(args, kwargs)
+            store = self.store
+            record = store.get(key)
             if record and not record.is_outdated():
                 return record.result
-            else:
-                result = self.func(*args, **kwargs)
-                self.call_record[all_args] = QueryRecord(result, self.refreshed_seconds)
+            elif record and not record.is_expired():
+                self.refresh_in_background(store, key, instance, args, kwargs)
+                return record.result
+            try:
+                return self.fetch(store, key, instance, args, kwargs)
+            except RequestError:
+                if record is None:
+                    raise
+                logger.warning("Serving an expired result of %s", self.namespace, exc_info=True)
+                return record.result
+
+        def fetch(self, store, key, instance, args, kwargs):
+            def fetch_and_save():
+                result = self.func(instance, *args, **kwargs)
+                self.save(store, key, kwargs, result)
                 return result
+            return self.single_flight.do(key, fetch_and_save)
+
+        def save(self, store, key, kwargs, result):
+            if getattr(_local, 'saving_skipped', False):
+                return
+            record = QueryRecord(result, self.refreshed_seconds, kwargs,
+                                 self.stale_seconds, self.error_seconds)
+            store.set(key, record, category)
+
+        def lookup(self, args, kwargs):
+            """
+            Return `(store, key, record)` of the call, the record is None
+            unless it's fresh. It's used by callers which fetch the
+            result by themselves, ex. `AsyncDisqusQuery`.
+            """
+            key = make_cache_key(args, kwargs)
+            store = self.store
+            record = store.get(key)
+            if record and record.is_outdated():
+                record = None
+            return store, key, record
+
+        def refresh_in_background(self, store, key, instance, args, kwargs):
+            generation = store.generation
+
+            def refresh():
+                result = self.func(instance, *args, **kwargs)
+                # Don't save the result if a write operation has
+                # changed the cache since it was requested.
+                if store.generation == generation:
+                    self.save(store, key, kwargs, result)
+                return result
+
+            background_refresher.submit(
+                (self.namespace, key),
+                lambda: self.single_flight.do(key, refresh)
+            )
 
         def __get__(self, instance, owner):
             def f(*args, **kwargs):
@@ -102,6 +784,143 @@ def query_cache(category, refreshed_seconds=5):
             return f
 
         def clear(self):
-            self.call_record = dict()
+            self.local_store.clear()
+            if getattr(settings, 'DISQUS_QUERY_CACHE', None) is not None:
+                self.store.clear()
+
+        def patch(self, change):
+            self.local_store.patch(category, change)
+            if getattr(settings, 'DISQUS_QUERY_CACHE', None) is not None:
+                self.store.patch(category, change)
 
     return QueryCache
+
+
+class CursorCache(object):
+    """
+    Remember the Disqus cursor of each row position we have seen
+    in a listing, so seeking to a late page can start from the nearest
+    known cursor instead of replaying every earlier page.
+    The positions shift once threads/posts are created or deleted, so a
+    cursor is only used as long as the pages of the listing `query_cache`
+    are served, and until the cache is cleared or patched, by any worker
+    process when `DISQUS_QUERY_CACHE` is shared.
+    """
+    def __init__(self, category, query_cache=None, max_listings=128):
+        # listing key -> (generation of the query cache, sorted positions,
+        #                 position -> (cursor, recorded time))
+        self.listings = dict()
+        self.query_cache = query_cache
+        self.max_listings = max_listings
+        self.lock = threading.Lock()
+        cache_registry.register(category, self)
+
+    @staticmethod
+    def make_key(kwargs):
+        return tuple(sorted((k, repr(v)) for k, v in kwargs.items()))
+
+    @property
+    def timeout(self):
+        if self.query_cache is None:
+            return 5
+        return self.query_cache.refreshed_seconds + self.query_cache.stale_seconds
+
+    def get_generation(self):
+        if self.query_cache is None:
+            return None
+        return self.query_cache.store.generation
+
+    def record(self, kwargs, position, cursor):
+        key = self.make_key(kwargs)
+        generation = self.get_generation()
+        with self.lock:
+            listing = self.listings.get(key)
+            if listing is None or listing[0] != generation:
+                self.listings.pop(key, None)
+                if len(self.listings) >= self.max_listings:
+                    self.listings.pop(next(iter(self.listings)))
+                listing = self.listings[key] = (generation, [], dict())
+            generation, positions, cursors = listing
+            if position not in cursors:
+                bisect.insort(positions, position)
+            cursors[position] = (cursor, time.time())
+
+    def seek(self, kwargs, offset):
+        """
+        Return the nearest known `(position, cursor)` before `offset`.
+        """
+        key = self.make_key(kwargs)
+        generation = self.get_generation()
+        expired_before = time.time() - self.timeout
+        with self.lock:
+            listing = self.listings.get(key)
+            if not listing:
+                return 0, None
+            if listing[0] != generation:
+                del self.listings[key]
+                return 0, None
+            generation, positions, cursors = listing
+            index = bisect.bisect_right(positions, offset)
+            while index > 0:
+                position = positions[index - 1]
+                cursor, recorded_at = cursors[position]
+                if recorded_at >= expired_before:
+                    return position, cursor
+                del positions[index - 1]
+                del cursors[position]
+                index -= 1
+            return 0, None
+
+    def patch(self, change):
+        # Only removed rows shift the positions of the others
+        if change.removed:
+            self.clear()
+
+    def clear(self):
+        self.listings = dict()
+
+
+class CountCache(object):
+    """
+    Remember the number of rows of the listings counted by
+    `DisqusQuerySet.count` for `DISQUS_COUNT_CACHE_SECONDS`, the admin
+    counts the same listing on every changelist render. Any change of
+    the `categories` clears it, since it may add or remove matched rows.
+    """
+    def __init__(self, categories, max_listings=256):
+        self.counts = OrderedDict()
+        self.max_listings = max_listings
+        self.lock = threading.Lock()
+        for category in categories:
+            cache_registry.register(category, self)
+
+    @property
+    def timeout(self):
+        # Counting a listing without filters pushed to Disqus walks
+        # every page of it, so a count is kept much longer than a page
+        return getattr(settings, 'DISQUS_COUNT_CACHE_SECONDS', 600)
+
+    @staticmethod
+    def make_key(entity, kwargs):
+        return (entity,) + CursorCache.make_key(kwargs)
+
+    def get(self, key):
+        with self.lock:
+            record = self.counts.get(key)
+            if record is None or record.is_outdated():
+                return None
+            return record.result
+
+    def set(self, key, count):
+        with self.lock:
+            self.counts.pop(key, None)
+            if len(self.counts) >= self.max_listings:
+                self.counts.popitem(last=False)
+            self.counts[key] = QueryRecord(count, self.timeout)
+
+    def patch(self, change):
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.counts = OrderedDict()